@@ -37,7 +37,7 @@ config = dict(
     ],
 
     packages=['src'],
-    install_requires=['numpy', 'plyfile', 'utm'],
+    install_requires=['numpy', 'plyfile', 'utm>=0.5'],
     extras_require={
         'test': ['mypy', 'pylint', 'sphinx'],
         },
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Analyse many sites in one run, sharing a pool of worker processes.
+
+Sites are listed in a manifest, or found in a directory.  A manifest is a
+``.csv`` file with a column ``file`` for the input of each site, and
+optional columns ``utmzone``, ``north``, ``out`` (the output directory), and
+``args`` (further options for that site, eg. ``--cellsize 0.05``).  Missing
+or empty values take the defaults given on the command line.  Relative
+paths in the manifest are relative to the manifest, and those given on the
+command line to the current directory.  For a directory, every ``.ply`` file
+(or ``.ply.gz``, ``.ply.xz``, or ``.las`` file) is a site, except for sparse
+clouds and later parts of Pix4D clouds.
+
+Sites run in parallel, while the total estimated memory use of running
+sites is within the budget.  Memory use is estimated from the number of
+vertices in the header of each input.  Sites whose analysis is newer than
+their input are skipped, and a failure is reported without stopping the
+other sites.  Run as ``forestutils batch``; see ``--help`` for options.
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import contextlib
+import csv
+import glob
+import os
+import shlex
+import time
+import traceback
+from typing import List, NamedTuple
+
+from . import forestutils, pointcloudfile
+
+# Rough peak memory of an analysis: a fixed overhead, plus the map and
+# chunks of points, which grow with the number of points.
+BASE_MEMORY = 2**26
+BYTES_PER_POINT = 16
+
+Site = NamedTuple('Site', [('file', str), ('out', str), ('argv', List[str]),
+                           ('memory', int)])
+
+
+def estimate_memory(fname: str) -> int:
+    """Return a rough estimate of the peak memory to analyse fname."""
+    try:
+        points = sum(p.stop for p in pointcloudfile.part_ranges(fname))
+    except (OSError, ValueError, StopIteration):
+        # The site will fail, and report why
+        points = 0
+    return BASE_MEMORY + BYTES_PER_POINT * points
+
+
+def find_inputs(directory: str) -> List[str]:
+    """Return the input files for every site in a directory."""
+    files = []  # type: List[str]
+    for pattern in ('*.ply', '*.ply.gz', '*.ply.xz', '*.las'):
+        files += glob.glob(os.path.join(directory, pattern))
+    return sorted(f for f in files if not (
+        pointcloudfile.stem(f).endswith('_sparse') or (
+            '_point_cloud_part_' in f and
+            not pointcloudfile.stem(f).endswith('_point_cloud_part_1'))))
+
+
+def read_sites(source: str, args: argparse.Namespace) -> List[Site]:
+    """Return the sites listed in a manifest, or found in a directory,
+    with defaults from the command-line args."""
+    if os.path.isdir(source):
+        rows = [{'file': f} for f in find_inputs(source)]
+        base = ''
+    else:
+        with open(source, newline='') as f:
+            rows = list(csv.DictReader(f))
+        base = os.path.dirname(source)
+    sites = []
+    for row in rows:
+        fname = os.path.join(base, row['file'])
+        out = os.path.join(base, row['out']) if row.get('out') else args.out
+        north = (row.get('north') or str(args.north)).lower() in (
+            'true', 'yes', '1', 'n', 'north')
+        argv = [fname, out, '--utmzone', row.get('utmzone') or
+                str(args.utmzone)]
+        argv += (['--north'] if north else []) + args.forestutils_args
+        argv += shlex.split(row.get('args') or '')
+        sites.append(Site(fname, out, argv, estimate_memory(fname)))
+    return sites
+
+
+def up_to_date(site: Site) -> bool:
+    """Return whether the analysis of the site is newer than its input."""
+    _, table = forestutils.output_files(site.file, site.out)
+    if not (os.path.isfile(table) and os.path.isfile(site.file)):
+        return False
+    return all(os.path.getmtime(f) <= os.path.getmtime(table)
+               for f in pointcloudfile.pix4d_parts(site.file))
+
+
+def log_file(fname: str, out: str) -> str:
+    """Return the name of the log of the site, beside the analysis."""
+    _, table = forestutils.output_files(fname, out)
+    return table[:-len('_analysis.csv')] + '_log.txt'
+
+
+def run_site(argv: List[str]) -> str:
+    """Analyse one site, with a log of output beside the analysis, and
+    return the name of the log.  Runs in a worker process.
+
+    If the site fails, its analysis is removed, so that it is not taken to
+    be up to date by the next run."""
+    args = forestutils.get_args(argv)
+    # pylint:disable=protected-access
+    forestutils._set_args(args)
+    _, table = forestutils.output_files(args.file, args.out)
+    log = log_file(args.file, args.out)
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    with open(log, 'w') as f, contextlib.redirect_stdout(f):
+        try:
+            forestutils.main_processing()
+        except Exception:
+            traceback.print_exc(file=f)
+            if os.path.isfile(table):
+                os.remove(table)
+            raise
+    return log
+
+
+def schedule(sites: List[Site], workers: int, memory: int) -> List[dict]:
+    """Run the sites on a pool of workers, starting each when its estimated
+    memory fits in the budget along with the sites already running.  A site
+    which is too large for the budget runs alone.  Return a result for
+    each site."""
+    pending = sorted(sites, key=lambda s: -s.memory)
+    running = {}  # type: dict
+    results = []
+    with ProcessPoolExecutor(workers) as pool:
+        while pending or running:
+            used = sum(s.memory for s, _ in running.values())
+            for site in list(pending):
+                if len(running) < workers and (
+                        not running or used + site.memory <= memory):
+                    future = pool.submit(run_site, site.argv)
+                    running[future] = (site, time.perf_counter())
+                    pending.remove(site)
+                    used += site.memory
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                site, start = running.pop(future)
+                result = {'file': site.file, 'status': 'done', 'error': '',
+                          'seconds': round(time.perf_counter() - start, 1),
+                          'log': log_file(site.file, site.out)}
+                try:
+                    future.result()
+                except Exception as err:  # pylint:disable=broad-except
+                    result.update(status='failed', error=repr(err))
+                print('{status:>7} {file} ({seconds}s) {error}'.format(
+                    **result))
+                results.append(result)
+    return results
+
+
+def get_args(argv=None):
+    """ Handle command-line arguments, including default values.
+    """
+    parser = argparse.ArgumentParser(
+        prog='forestutils batch',
+        description=('Analyses every site in a directory or manifest, '
+                     'in parallel within a memory budget.'),
+        epilog=('Other arguments, eg. --cellsize 0.05, are passed to the '
+                'analysis of every site; see forestutils --help.'))
+    parser.add_argument(
+        'source', help='directory of .ply files, or manifest .csv file')
+    parser.add_argument(
+        '--out', default='.',
+        help='output directory for sites without one in the manifest')
+    parser.add_argument(
+        '--utmzone', default=55, type=int,
+        help='UTM zone for sites without one in the manifest (default 55)')
+    parser.add_argument(
+        '--north', action='store_true',
+        help='sites without a hemisphere in the manifest are in the north')
+    parser.add_argument(
+        '--workers', default=os.cpu_count() or 1, type=int,
+        help='number of sites to analyse at once (default one per CPU)')
+    parser.add_argument(
+        '--memory', default=4096, type=int,
+        help='megabytes of memory to share between sites (default 4096)')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='analyse sites even if the analysis is newer than the input')
+    parser.add_argument(
+        '--report', default='batch_report.csv',
+        help='file to save the result of each site (default %(default)s)')
+    args, args.forestutils_args = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv=None):
+    """Analyse many sites, as for ``forestutils batch``."""
+    args = get_args(argv)
+    sites = read_sites(args.source, args)
+    todo = [s for s in sites if args.force or not up_to_date(s)]
+    print('Analysing {} of {} sites; the rest are up to date.'.format(
+        len(todo), len(sites)))
+    results = schedule(todo, args.workers, args.memory * 2**20)
+    results += [{'file': s.file, 'status': 'skipped', 'error': '',
+                 'seconds': 0} for s in sites if s not in todo]
+    with open(args.report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, ('file', 'status', 'seconds', 'error',
+                                    'log'), restval='')
+        writer.writeheader()
+        writer.writerows(results)
+    failed = sum(r['status'] == 'failed' for r in results)
+    print('{} sites failed; see "{}".'.format(failed, args.report))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Synthetic forest point clouds, and a benchmark of forestutils on them.
+
+:py:func:`synthetic_forest` yields a deterministic cloud of a sloping,
+slightly uneven ground plane with cone and ellipsoid tree crowns, noise,
+and RGB colours - at any size, in bounded memory.  :py:func:`write_forest`
+saves such a cloud with :py:func:`~src.pointcloudfile.write`.
+
+Run ``python -m src.benchmark`` to time each stage of the analysis over
+synthetic clouds of several sizes, reporting throughput and the peak memory
+of a fresh process for each stage.  See ``--help`` for options.
+"""
+# pylint:disable=no-member
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import tempfile
+import time
+from typing import Any, Iterator
+
+import numpy as np
+
+from . import forestutils, grid, pointcloudfile, profiling
+
+
+HEADER = pointcloudfile.PlyHeader(
+    0, ('x', 'y', 'z', 'red', 'green', 'blue'), '<fffBBB', ())
+UTM = pointcloudfile.UTM_Coord(690000.0, 6090000.0, 55, False)
+
+# Points per square metre, and square metres of site per tree
+DENSITY = 400
+AREA_PER_TREE = 60
+# As for chunks from pointcloudfile.read_chunks with HEADER
+DTYPE = np.dtype([('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
+                  ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+
+def _crowns(trees: np.ndarray, rng, count: int):
+    """Return x, y, and height above ground of count random points on the
+    surface of the tree crowns."""
+    t = trees[rng.randint(0, trees.size, count)]
+    angle = rng.uniform(0, 2 * np.pi, count)
+    level = rng.random_sample(count)
+    # Cones narrow linearly to the top; ellipsoids are round
+    width = np.where(t['cone'], 1 - level, np.sqrt(1 - (2 * level - 1) ** 2))
+    dist = t['radius'] * width
+    return (t['x'] + dist * np.cos(angle), t['y'] + dist * np.sin(angle),
+            t['height'] - t['depth'] * (1 - level))
+
+
+def _ground(x, y):
+    """Height of the synthetic ground at x, y."""
+    return 0.05 * x + 0.02 * y + 0.3 * np.sin(x / 7) * np.cos(y / 11)
+
+
+def synthetic_forest(points: int, seed: int=0,
+                     chunk_size: int=2**18) -> Iterator[np.ndarray]:
+    """Yield chunks of a synthetic forest point cloud, as structured arrays
+    like those from :py:func:`~src.pointcloudfile.read_chunks`.
+
+    The site is square and sized for a constant density of points.  About
+    40% of points are on the ground, which slopes and undulates gently;
+    the rest are on the surface of tree crowns, each a cone or an
+    ellipsoid.  Output depends only on ``points`` and ``seed``.
+    """
+    side = (points / DENSITY) ** 0.5
+    rng = np.random.RandomState(seed)
+    trees = np.zeros(max(1, int(side ** 2 / AREA_PER_TREE)), dtype=[
+        ('x', 'f8'), ('y', 'f8'), ('radius', 'f8'), ('height', 'f8'),
+        ('depth', 'f8'), ('cone', '?')])
+    trees['x'] = rng.uniform(0, side, trees.size)
+    trees['y'] = rng.uniform(0, side, trees.size)
+    trees['radius'] = rng.uniform(1.5, 4, trees.size)
+    trees['height'] = rng.uniform(4, 20, trees.size)
+    trees['depth'] = trees['height'] * rng.uniform(0.3, 0.7, trees.size)
+    trees['cone'] = rng.random_sample(trees.size) < 0.5
+
+    for start in range(0, points, chunk_size):
+        n = min(chunk_size, points - start)
+        rng = np.random.RandomState([seed, start // chunk_size])
+        chunk = np.zeros(n, dtype=DTYPE)
+        crown = rng.random_sample(n) >= 0.4
+        # Ground points are uniform over the site
+        chunk['x'] = rng.uniform(0, side, n)
+        chunk['y'] = rng.uniform(0, side, n)
+        chunk['x'][crown], chunk['y'][crown], height = _crowns(
+            trees, rng, int(np.count_nonzero(crown)))
+        chunk['z'] = _ground(chunk['x'], chunk['y'])
+        chunk['z'][crown] += height
+        chunk['z'] += rng.normal(0, 0.05, n)
+        # Brown ground and green canopy, with some variation
+        base = np.where(crown[:, None], [[50, 120, 40]], [[110, 90, 60]])
+        colours = np.clip(base + rng.normal(0, 15, (n, 3)), 0, 255)
+        for i, name in enumerate(('red', 'green', 'blue')):
+            chunk[name] = colours[:, i]
+        yield chunk
+
+
+def write_forest(fname: str, points: int, seed: int=0) -> None:
+    """Save a synthetic forest point cloud to fname."""
+    pointcloudfile.write(synthetic_forest(points, seed), fname, HEADER, UTM)
+
+
+def _raw_map(fname: str) -> forestutils.MapObj:
+    """Return a MapObj with binned but unsmoothed, unlabelled layers."""
+    attr_map = forestutils.MapObj.__new__(forestutils.MapObj)
+    attr_map.raster = forestutils.bin_points(
+        pointcloudfile.read_chunks(fname))
+    attr_map.raster.trim(attr_map.raster['density'] > 0)
+    return attr_map
+
+
+def _run_stage(stage: str, fname: str, argv: list) -> dict:
+    """Run one stage of the analysis, and return measurements.
+
+    Runs in a fresh worker process, so peak memory is for this stage alone
+    (plus any setup the stage requires, eg. reading the map).
+    """
+    # pylint:disable=protected-access
+    forestutils.args = forestutils.get_args([fname] + argv)
+    points = pointcloudfile.parse_ply_header(
+        pointcloudfile.ply_header_text(fname)).vertex_count
+    setup = {
+        'smooth_ground': lambda: _raw_map(fname),
+        'connected_components': lambda: forestutils.MapObj(
+            fname, colours=False),
+        'save_sparse_cloud': lambda: forestutils.MapObj(fname, colours=False),
+        'save_individual_trees': lambda: forestutils.MapObj(fname),
+    }.get(stage, lambda: None)()  # type: Any
+    with tempfile.TemporaryDirectory() as tmp:
+        forestutils.args.savetrees = os.path.join(tmp, 'trees')
+        start = time.perf_counter()
+        if stage == 'read':
+            for _ in pointcloudfile.read(fname):
+                pass
+        elif stage == 'read_chunks':
+            for _ in pointcloudfile.read_chunks(fname):
+                pass
+        elif stage == 'update_spatial':
+            forestutils.MapObj(fname, colours=False)
+        elif stage == 'smooth_ground':
+            grid.smooth_ground(setup.raster['ground'],
+                               forestutils.args.cellsize)
+        elif stage == 'connected_components':
+            setup._tree_components()
+        elif stage == 'save_sparse_cloud':
+            setup.save_sparse_cloud(os.path.join(tmp, 'sparse.ply'))
+        elif stage == 'save_individual_trees':
+            setup.save_individual_trees()
+        else:
+            raise ValueError('Unknown stage: ' + stage)
+        elapsed = time.perf_counter() - start
+    return {'stage': stage, 'points': points, 'seconds': elapsed,
+            'points_per_second': points / elapsed if elapsed else None,
+            'peak_rss_bytes': profiling.peak_rss()}
+
+
+STAGES = ('read', 'read_chunks', 'update_spatial', 'smooth_ground',
+          'connected_components', 'save_sparse_cloud',
+          'save_individual_trees')
+
+
+def get_args(argv=None):
+    """ Handle command-line arguments, including default values.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark forestutils over synthetic forest clouds.')
+    parser.add_argument(
+        '--sizes', default=[1e5, 1e6], nargs='+', type=float,
+        help='numbers of points in each synthetic cloud (default 1e5 1e6)')
+    parser.add_argument(
+        '--stages', default=STAGES, nargs='+', choices=STAGES,
+        help='stages of the analysis to time (default all)')
+    parser.add_argument(
+        '--dir', default=tempfile.gettempdir(),
+        help='where to save (and reuse) synthetic clouds')
+    parser.add_argument(
+        '--seed', default=0, type=int, help='seed for synthetic clouds')
+    parser.add_argument(
+        '--json', default='', help='also save results to this JSON file')
+    parser.add_argument(
+        'forestutils_args', nargs=argparse.REMAINDER,
+        help='further arguments for forestutils, eg. --cellsize 0.05')
+    return parser.parse_args(argv)
+
+
+def main():
+    """Generate synthetic clouds as needed, and benchmark each stage."""
+    args = get_args()
+    results = []
+    print('{:>12} {:>22} {:>10} {:>14} {:>10}'.format(
+        'points', 'stage', 'seconds', 'points/sec', 'peak MB'))
+    for size in (int(s) for s in args.sizes):
+        fname = os.path.join(args.dir, 'synthetic_forest_{}_{}.ply'.format(
+            size, args.seed))
+        if not os.path.isfile(fname):
+            write_forest(fname, size, args.seed)
+        for stage in args.stages:
+            with ProcessPoolExecutor(1) as pool:
+                res = pool.submit(_run_stage, stage, fname,
+                                  args.forestutils_args).result()
+            results.append(res)
+            print('{points:>12} {stage:>22} {seconds:>10.2f} '
+                  '{points_per_second:>14,.0f} {0:>10.0f}'.format(
+                      res['peak_rss_bytes'] / 2**20, **res))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
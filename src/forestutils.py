@@ -14,9 +14,9 @@ Outputs (most are optional):
   height, canopy area, colour, and point count.
 * Individual files containing the point cloud for each tree.
 
-Extensive use of mutable coordinate-property mappings and streamed input
-ensure that even files too large to load in memory can be processed.  In extreme
-cases, the resolution can be decreased to trade accuracy for memory.
+Compact array-backed maps of cell properties and streamed input ensure that
+even files too large to load in memory can be processed.  In extreme cases,
+the resolution can be decreased to trade accuracy for memory.
 
 Example outputs (from an older version):
 `a map <https://www.google.com/maps/d/viewer?mid=z1pH7HaTWL9Q.kzQflQGYVRIU>`_,
@@ -25,303 +25,529 @@ and `pointclouds <http://phenocam.org.au/pointclouds>`_.
 # pylint:disable=unsubscriptable-object
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
-import math
+import importlib
+import itertools
+import json
 import os
-# `Dict` used in a variable annotation, with comment syntax for Python <3.6
-from typing import Dict, MutableMapping, NamedTuple, Tuple, Set  # pylint:disable=unused-import
+import sys
+import tempfile
+from typing import Any, List, Optional, Tuple
 
+import numpy as np
 import utm
 
-from . import pointcloudfile
+from . import grid, pointcloudfile, profiling
+from .raster import Raster
 
 
-# User-defined types
-XY_Coord = NamedTuple('XY_Coord', [('x', int), ('y', int)])
-Coord_Labels = MutableMapping[XY_Coord, int]
+# The map to detect trees in, for workers in a sweep over options
+_SWEEP_MAP = None  # type: Any
 
 
-def coords(pos):
-    """ Return a tuple of integer coordinates as keys for the MapObj dict/map.
-    This is necessary because the MapObj uses a dictionary to store each
-    attribute.
-
-    * pos can be a full point tuple, or just (x, y)
-    * use floor() to avoid imprecise float issues
+def chunk_coords(chunk) -> Tuple[np.ndarray, np.ndarray]:
+    """Return arrays of the integer x and y coordinates of the grid cell
+    containing each point in a structured array, as used to index the
+    MapObj raster.
     """
-    x = math.floor(pos.x / args.cellsize)
-    y = math.floor(pos.y / args.cellsize)
-    return XY_Coord(x, y)
+    x = np.floor(chunk['x'] / args.cellsize).astype(np.int64)
+    y = np.floor(chunk['y'] / args.cellsize).astype(np.int64)
+    return x, y
 
 
-def neighbors(key: XY_Coord) -> Tuple[XY_Coord, ...]:  # pylint:disable=invalid-sequence-index
-    """ Take an XY coordinate key and return the adjacent keys,
-	 whether they exist or not.
+def bin_points(chunks, raster: Optional[Raster]=None) -> Raster:
+    """Add the count, highest, and lowest point in each cell to the density,
+    canopy, and ground layers of the raster (default a new raster).
     """
-    return tuple(XY_Coord(key.x + a, key.y + b)
-                 for a in (-1, 0, 1) for b in (-1, 0, 1) if a or b)
+    if raster is None:
+        raster = Raster()
+        raster.add_layer('density', np.int32)
+        raster.add_layer('canopy', np.float64, -np.inf)
+        raster.add_layer('ground', np.float64, np.inf)
+    for chunk in chunks:
+        x, y = chunk_coords(chunk)
+        raster.cover(x, y)
+        raster.reduce_at(x, y, density=(np.add, None),
+                         canopy=(np.maximum, chunk['z']),
+                         ground=(np.minimum, chunk['z']))
+    return raster
+
+
+def _set_args(namespace: argparse.Namespace) -> None:
+    """Set the global args, eg. in a worker process."""
+    # pylint:disable=global-statement
+    global args
+    args = namespace
+    pointcloudfile.ReadAhead.buffer_size = args.readbuffer * 2**20
+    pointcloudfile.ReadAhead.depth = args.readdepth
 
 
-def connected_components(input_dict: Coord_Labels) -> None:
-    """ Connected components in a dict of coordinates.
-    Uses depth-first search.  Non-component cells are absent from the input.
-    """
-    def expand(old_key: XY_Coord, com: MutableMapping) -> None:
-        """Implement depth-first search.
-		"""
-        for key in neighbors(old_key):
-            if com.get(key) is None:
-                return
-            if com[key] == com[old_key]:
-                continue
-            elif com[key] < com[old_key]:
-                com[old_key] = com[key]
-            else:
-                com[key] = com[old_key]
-                expand(key, com)
-
-    for key in tuple(input_dict):
-        try:
-            expand(key, input_dict)
-        except RuntimeError:
-            # Recursion depth; finish on next pass.
-            continue
+def _set_sweep(namespace: argparse.Namespace, attr_map: 'MapObj') -> None:
+    """Set the global args and the map to sweep, in a worker process."""
+    # pylint:disable=global-statement
+    global _SWEEP_MAP
+    _set_args(namespace)
+    _SWEEP_MAP = attr_map
 
 
-def detect_issues(ground_dict: Coord_Labels, prior: set) -> Set[XY_Coord]:
-    """Identifies cells with more than 2:1 slope to 3+ adjacent cells.
-    """
-    problematic = set()
-    for k in prior:
-        adjacent = {ground_dict.get(n) for n in neighbors(k)}
-        adjacent.discard(None)
-        if len(adjacent) < 6:
-            continue
-        # Number of cells at more than 2:1 slope - suspiciously steep.
-        # 3+ usually indicates a misclassified cell or data artefact.
-        probs = sum(abs(ground_dict[k]-n) > 2*args.cellsize for n in adjacent)
-        if probs >= 3:
-            problematic.add(k)
-    return problematic
-
-
-def smooth_ground(ground_dict: Coord_Labels) -> None:
-    """Smooths the ground map, to reduce the impact of spurious points, eg.
-    points far underground or misclassification of canopy as ground.
+def _sweep_one(slicedepth: float, joinedcells: float, out: str) -> int:
+    """Detect trees in the map for sweep with the given options, save the
+    analysis to out, and return the number of trees."""
+    args.slicedepth = slicedepth
+    args.joinedcells = joinedcells
+    _SWEEP_MAP.raster['trees'] = grid.tree_components(
+        _SWEEP_MAP.raster, slicedepth, joinedcells)
+    return _SWEEP_MAP.stream_analysis(out)
+
+
+def sweep(attr_map: 'MapObj', table: str) -> str:
+    """Detect trees with each combination of slicedepth and joinedcells in
+    args.sweep, reusing the map.  Saves the analysis for each combination
+    beside table, and a summary of the number of trees, and returns the
+    name of the summary.
+
+    Combinations are run in parallel with ``--workers``.
     """
-    problematic = set(ground_dict)
-    for _ in range(100):
-        problematic = detect_issues(ground_dict, problematic)
-        for key in problematic:
-            adjacent = {ground_dict.get(n) for n in neighbors(key)
-                        if n not in problematic}
-            adjacent.discard(None)
-            if not adjacent:
-                continue
-            ground_dict[key] = min(adjacent) + 2*args.cellsize
+    base = table[:-len('_analysis.csv')]
+    outs = ['{}_analysis_slicedepth{:g}_joinedcells{:g}.csv'.format(
+        base, sd, jc) for sd, jc in args.sweep]
+    slicedepths, joinedcells = zip(*args.sweep)
+    with ProcessPoolExecutor(max(1, args.workers), initializer=_set_sweep,
+                             initargs=(args, attr_map)) as pool:
+        counts = list(pool.map(_sweep_one, slicedepths, joinedcells, outs))
+    summary = base + '_sweep.csv'
+    with open(summary, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(('slicedepth', 'joinedcells', 'trees', 'analysis'))
+        writer.writerows(zip(slicedepths, joinedcells, counts,
+                             (os.path.basename(f) for f in outs)))
+    return summary
 
 
 class MapObj:
     """Stores a maximum and minimum height map of the cloud, in GRID_SIZE
     cells.  Hides data structure and accessed through coordinates.
-    Data structure is a set of dictionaries, one for each attribute. Each dict
-    is a contains, for a single attribute, all the values for all the points.
+    Data structure is a :py:class:`~src.raster.Raster`, with a layer for
+    each attribute.  Each layer holds, for a single attribute, the value
+    for every cell in the bounding box of the cloud.
     """
     # pylint:disable=too-many-instance-attributes
 
-    def __init__(self, input_file, *, colours=True):
+    def __init__(self, input_file, *, colours=True, spill=False):
         """
         Args:
             input_file (path): the ``.ply`` file to process.  If dealing with
                 Pix4D outputs, ``*_part_1.ply``.
             colours (bool): whether to read colours from the file.  Set to
                 False for eg. LIDAR data where mean colour is not useful.
+            spill (bool): whether to copy points to a temporary file while
+                reading the input, for use by :py:meth:`save_all` instead
+                of reading the input again.
             prev_csv (path): path to a csv file which associates a name
                 with coordinates, to correctly name detected trees.
             zone (int): the UTM zone of the site.
             south (bool): if the site is in the southern hemisphere.
         """
-        self.file = input_file
-        self.canopy = dict()
-        self.density = dict()
-        self.filtered_density = dict()
-        self.ground = dict()
-        self.colours = dict()
-        self.trees = dict()
-
-        self.header = pointcloudfile.parse_ply_header(
-            pointcloudfile.ply_header_text(input_file))
-        x, y, _ = pointcloudfile.offset_for(input_file)
-        self.utm = pointcloudfile.UTM_Coord(x, y, args.utmzone, args.north)
+        self.spill = tempfile.TemporaryFile() if spill else None
+        self.spill_dtype = None
+        # The stored type, part offset, and size of each spilled chunk
+        self.spilled = []  # type: list
+        self.smoothing_iterations = 0
+        self.raster = Raster()
+        self.raster.add_layer('density', np.int32)
+        self.raster.add_layer('filtered_density', np.int32)
+        self.raster.add_layer('canopy', np.float64, -np.inf)
+        self.raster.add_layer('ground', np.float64, np.inf)
+        self.raster.add_layer('trees', np.int32, -1)
+        self._set_file(input_file)
+        for name in self.colours:
+            self.raster.add_layer('colour_' + name, np.float64)
 
         self.update_spatial()
         if colours:
             self.update_colours()
 
+    def _set_file(self, input_file):
+        """Set the input file, and attributes from its header."""
+        self.file = input_file
+        # Whether to keep only points in the sparse cloud when saving trees
+        # from self.file, as the sparse cloud is compressed
+        self.sparse_only = False
+        self.header = pointcloudfile.read_header(input_file)
+        # We assume that vertex attributes not named "x", "y" or "z"
+        # are colours, and thus accumulate a total to get the mean
+        self.colours = tuple(a for a in self.header.names if a not in 'xyz')
+        x, y, _ = pointcloudfile.offset_for(input_file)
+        self.utm = pointcloudfile.UTM_Coord(x, y, args.utmzone, args.north)
+
+    @classmethod
+    def load(cls, cache: str, input_file: str, key: dict):
+        """Return a map of input_file from the cache saved by :py:meth:`save`
+        with the same key, or None if there is no such cache.
+
+        Points are not read; trees are detected again, so the cache can be
+        reused with any ``--slicedepth`` or ``--joinedcells``.
+        """
+        if not os.path.isfile(cache):
+            return None
+        with profiling.stage('load_cache'), \
+                np.load(cache) as data:
+            if 'key' not in data or json.loads(str(data['key'])) != key:
+                return None
+            self = cls.__new__(cls)
+            self.raster = Raster.load(data)
+            self.smoothing_iterations = int(data['smoothing_iterations'])
+        self.spill = None
+        self.spill_dtype = None
+        self.spilled = []
+        self._set_file(input_file)
+        self.raster.add_layer('trees', np.int32, -1)
+        with profiling.stage('label', len(self)):
+            self.raster['trees'] = self._tree_components()
+        return self
+
+    def save(self, cache: str, key: dict) -> None:
+        """Save the map except for trees to the file cache, with the key of
+        the input for :py:meth:`load`."""
+        with profiling.stage('save_cache'):
+            self.raster.save(
+                cache, [n for n in self.raster.layers if n != 'trees'],
+                key=np.array(json.dumps(key, sort_keys=True)),
+                smoothing_iterations=np.array(self.smoothing_iterations))
+
     def update_spatial(self):
         """ Expand, correct, or maintain map with a new observed point.
 			Initialize density and filtered_density to 1. Increment
 			density but do not incerement filtered_density - that is done in
 			function update_colors
         """
-        # Fill out the spatial info in the file
-        for p in pointcloudfile.read(self.file):
-            idx = coords(p)
-            if self.density.get(idx) is None:
-                self.density[idx] = 1
-                self.canopy[idx] = p.z
-                self.ground[idx] = p.z
-                self.filtered_density[idx] = 1
-                continue
-            self.density[idx] += 1
-            if self.ground[idx] > p.z:
-                self.ground[idx] = p.z
-            elif self.canopy[idx] < p.z:
-                self.canopy[idx] = p.z
-        smooth_ground(self.ground)
-        self.trees = self._tree_components()
+        # Fill out the spatial info in the file, reducing each chunk of
+        # points into the raster cells at once
+        with profiling.stage('bin') as record:
+            self._bin()
+            record['points'] = len(self)
+        if args.workers > 1:
+            with profiling.stage('smooth_and_label', len(self)):
+                self.smoothing_iterations = grid.tiled_analysis(
+                    self.raster, args)
+        else:
+            with profiling.stage('smooth', len(self)):
+                self.smoothing_iterations = grid.smooth_ground(
+                    self.raster['ground'], args.cellsize)
+            with profiling.stage('label', len(self)):
+                self.raster['trees'] = self._tree_components()
+
+    def _bin(self):
+        """Bin points from the input file into the density, canopy, and
+        ground layers, and trim the map to the occupied cells."""
+        if args.workers > 1 and self.spill is None:
+            # Bin a range of the file per worker, and combine the results
+            # as they arrive - so at most one raster per worker is held
+            with ProcessPoolExecutor(args.workers, initializer=_set_args,
+                                     initargs=(args,)) as pool:
+                for part in pointcloudfile.map_ranges(
+                        bin_points, self.file, pool, args.workers):
+                    self.raster.combine(part, density=np.add,
+                                        canopy=np.maximum, ground=np.minimum)
+        elif self.spill is not None:
+            # Read each part, to spill coordinates relative to its offset
+            for part in pointcloudfile.part_ranges(self.file):
+                for chunk in pointcloudfile.read_range(part):
+                    self._spill(chunk, part.offset)
+                    bin_points([chunk], self.raster)
+        else:
+            bin_points(pointcloudfile.read_chunks(self.file), self.raster)
+        occupied = self.raster['density'] > 0
+        self.raster['filtered_density'][occupied] = 1
+        self.raster.trim(occupied)
 
     def update_colours(self):
         """Expand, correct, or maintain map with a new observed point.
         """
-        # We assume that vertex attributes not named "x", "y" or "z"
-        # are colours, and thus accumulate a total to get the mean
-        for p in pointcloudfile.read(self.file):
-            if self.is_ground(p):
-                continue
-            p_cols = {k: v for k, v in p._asdict().items() if k not in 'xyz'}
-            idx = coords(p)
-            # update filtered_density and divide by this later
-            self.filtered_density[idx] += 1
-            if idx not in self.colours:
-                self.colours[idx] = p_cols
-            else:
-                for k, v in p_cols.items():
-                    self.colours[idx][k] += v
-
-    def is_ground(self, point) -> bool:
-        """Returns boolean whether the point is not classified as ground - i.e.
-        True if within GROUND_DEPTH of the lowest point in the cell.
+        with profiling.stage('colours') as record:
+            for chunk in pointcloudfile.read_chunks(self.file):
+                self._add_colours(chunk)
+                record['points'] += chunk.size
+
+    def _add_colours(self, chunk):
+        """Add the colours of non-ground points in chunk to the map."""
+        chunk = chunk[~self.is_ground(chunk)]
+        x, y = chunk_coords(chunk)
+        # update filtered_density and divide by this later
+        updates = {'colour_' + name: (np.add, chunk[name])
+                   for name in self.colours}
+        self.raster.reduce_at(
+            x, y, filtered_density=(np.add, None), **updates)
+
+    def is_ground(self, points) -> np.ndarray:
+        """Returns boolean whether each point is not classified as ground -
+        i.e. True if within GROUND_DEPTH of the lowest point in the cell.
         If not lossy, also true for lowest ground point in a cell.
         """
-        return point[2] - self.ground[coords(point)] < args.grounddepth
+        ground = self.raster.get('ground', *chunk_coords(points))
+        return points['z'] - ground < args.grounddepth
 
-    def is_lowest(self, point) -> bool:
-        """Returns boolean whether the point is lowest in that grid cell.
+    def is_lowest(self, points) -> np.ndarray:
+        """Returns boolean whether each point is lowest in that grid cell.
         """
-        return point[2] == self.ground[coords(point)]
+        return points['z'] == self.raster.get('ground', *chunk_coords(points))
 
     def __len__(self) -> int:
         """Total observed points.
         """
-        return sum(self.density.values())
+        return int(self.raster['density'].sum())
 
-    def _tree_components(self) -> Coord_Labels:
-        """Returns a dict where keys refer to connected components.
-        NB: Not all keys in other dicts exist in this output.
+    @property
+    def cell_count(self) -> int:
+        """Number of cells containing at least one point.
         """
-        # Set up a boolean array of larger keys to search
-        key_scale_record = {}  # type: Dict[XY_Coord, Set[XY_Coord]]
-        for key in self.density:
-            if self.canopy[key] - self.ground[key] > args.slicedepth:
-                cc_key = XY_Coord(int(math.floor(key.x / args.joinedcells)),
-                                  int(math.floor(key.y / args.joinedcells)))
-                if cc_key not in key_scale_record:
-                    key_scale_record[cc_key] = {key}
-                else:
-                    key_scale_record[cc_key].add(key)
-        # Assign a unique integer value to each large key, then search
-        # Final labels are positive ints, but not ordered or consecutive
-        trees = {k: i for i, k in enumerate(tuple(key_scale_record))}
-        connected_components(trees)
-        # Copy labels to grid of original scale
-        return {s: trees[k] for k, v in key_scale_record.items() for s in v}
-
-    def tree_data(self, keys: Set[XY_Coord]) -> dict:
-        """Return a dictionary of data about the tree in the given keys.
+        return int(np.count_nonzero(self.raster['density']))
+
+    def _tree_components(self) -> np.ndarray:
+        """Returns an array of labels for connected components in each cell.
+        NB: Cells which are not part of any component are labelled -1.
+        """
+        return grid.tree_components(
+            self.raster, args.slicedepth, args.joinedcells)
+
+    def _tree_cells(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the indices i, j of every cell in a tree, sorted by tree
+        label, and the position of the first cell of each tree.
         """
+        i, j = np.nonzero(self.raster['trees'] >= 0)
+        order = np.argsort(self.raster['trees'][i, j], kind='stable')
+        i, j = i[order], j[order]
+        ids = self.raster['trees'][i, j]
+        starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+        return i, j, starts[:ids.size]
+
+    def tree_data(self) -> dict:
+        """Return a dictionary of arrays of data about every tree, in order
+        of tree label.
+
+        Cells are grouped by label once, and each attribute of every tree
+        is reduced over its cells at once, so the cost does not depend on
+        the number of trees.
+        """
+        i, j, starts = self._tree_cells()
+        n = np.diff(np.append(starts, i.size))
+
+        def total(values: np.ndarray) -> np.ndarray:
+            """Return the sum of values over the cells of each tree."""
+            return np.add.reduceat(values, starts)
+
         # Calculate positional information
-        x = self.utm.x + args.cellsize * sum(k.x for k in keys) / len(keys)
-        y = self.utm.y + args.cellsize * sum(k.y for k in keys) / len(keys)
-        lat, lon = utm.to_latlon(x, y, self.utm.zone, northern=self.utm.north)
+        x, y = self.raster.coords(i.astype(np.int64), j.astype(np.int64))
+        x = self.utm.x + args.cellsize * total(x) / n
+        y = self.utm.y + args.cellsize * total(y) / n
+        # The utm package converts arrays, but not empty ones
+        lat, lon = np.empty(0), np.empty(0)
+        if n.size:
+            lat, lon = utm.to_latlon(x, y, self.utm.zone,
+                                     northern=self.utm.north)
+        canopy = self.raster['canopy'][i, j]
+        ground = self.raster['ground'][i, j]
         out = {
             'latitude': lat,
             'longitude': lon,
             'UTM_X': x,
             'UTM_Y': y,
-            'UTM_zone': args.utmzone,
-            'height': 0,
-            'area': len(keys) * args.cellsize**2,
-            'base_altitude': sum(self.ground[k] for k in keys) / len(keys),
-            'point_count': 0,
+            'UTM_zone': np.full(n.size, args.utmzone),
+            'height': np.maximum(
+                0, np.maximum.reduceat(canopy - ground, starts)),
+            'area': n * args.cellsize**2,
+            'base_altitude': total(ground) / n,
+            'point_count': total(
+                self.raster['density'][i, j].astype(np.int64)),
             }
-        for k in keys:
-            out['height'] = max(out['height'], self.canopy[k] - self.ground[k])
-            out['point_count'] += self.density[k]
-            for colour, total in self.colours[k].items():
-                out[colour] = total / self.filtered_density[k]
+        filtered = total(
+            self.raster['filtered_density'][i, j].astype(np.int64))
+        for colour in self.colours:
+            out[colour] = total(self.raster['colour_' + colour][i, j]) / \
+                filtered
         return out
 
     def all_trees(self):
         """ Yield the characteristics of each tree.
         """
-        ids = list(set(self.trees.values()))
-        keys = {v: set() for v in ids}
-        for k, v in self.trees.items():
-            if v is None:
-                continue
-            keys[v].add(k)
-        for v in ids:
-            data = self.tree_data(keys[v])
-            if data['height'] > 1.5 * args.slicedepth:
-                # Filter trees by height
-                yield data
+        data = self.tree_data()
+        # Filter trees by height
+        keep = data['height'] > 1.5 * args.slicedepth
+        columns = {name: values[keep].tolist()
+                   for name, values in data.items()}
+        for row in zip(*columns.values()):
+            yield dict(zip(columns, row))
 
     def save_sparse_cloud(self, new_fname, lowest=True, canopy=True):
         """ Yield points for a sparse point cloud, eliminating ~3/4 of all
         points without affecting analysis.
+
+        Later passes read the sparse cloud instead of the input, unless it
+        is compressed - quantised coordinates could move points between
+        cells, and so change the analysis.  Trees are then saved from the
+        points of the input which are in the sparse cloud.
         """
-        newpoints = (point for point in pointcloudfile.read(self.file)
-                     if canopy and not self.is_ground(point) or
-                     lowest and self.is_lowest(point))
-        pointcloudfile.write(newpoints, new_fname, self.header, self.utm)
-        if lowest and canopy:
+        def sparse_points(record):
+            """Yield the points to keep from each chunk of the input."""
+            for chunk in pointcloudfile.read_chunks(self.file):
+                record['points'] += chunk.size
+                yield chunk[self._sparse(chunk, lowest, canopy)]
+        with profiling.stage('sparse') as record:
+            pointcloudfile.write(
+                sparse_points(record), new_fname, self.header, self.utm,
+                args.compress, args.precision)
+        if lowest and canopy and args.compress:
+            self.sparse_only = True
+        elif lowest and canopy:
             self.file = new_fname
 
+    def _sparse(self, chunk, lowest=True, canopy=True) -> np.ndarray:
+        """Return a mask of the points in chunk to keep in a sparse cloud."""
+        keep = np.zeros(chunk.shape, dtype=bool)
+        if canopy:
+            keep |= ~self.is_ground(chunk)
+        if lowest:
+            keep |= self.is_lowest(chunk)
+        return keep
+
     def save_individual_trees(self):
         """Save single trees to files.
         """
         if not args.savetrees:
             return
+        with profiling.stage('trees') as record:
+            with self._tree_writer() as trees:
+                for chunk in pointcloudfile.read_chunks(self.file):
+                    record['points'] += chunk.size
+                    if self.sparse_only:
+                        chunk = chunk[self._sparse(chunk)]
+                    self._save_tree_points(chunk, trees)
+
+    def _tree_writer(self) -> pointcloudfile.PartitionWriter:
+        """Return a writer which saves points to a file for each tree, in
+        the directory given by args.savetrees."""
         if os.path.isfile(args.savetrees):
             raise IOError('Output dir for trees is already a file')
         if not os.path.isdir(args.savetrees):
             os.makedirs(args.savetrees)
-        # Maps tree ID numbers to a incremental writer for that tree
-        tree_to_file = {tree_ID: pointcloudfile.IncrementalWriter(
-            os.path.join(args.savetrees, 'tree_{}.ply'.format(tree_ID)),
-            self.header, self.utm) for tree_ID in set(self.trees.values())}
-        # For non-ground, find the appropriate writer and call with the point
-        for point in pointcloudfile.read(self.file):
-            val = self.trees.get(coords(point))
-            if val is not None:
-                tree_to_file[val](point)
-
-    def stream_analysis(self, out: str) -> None:
-        """ Save the list of trees with attributes to the file 'out'.
+        return pointcloudfile.PartitionWriter(
+            lambda tree_ID: os.path.join(
+                args.savetrees, 'tree_{}.ply'.format(tree_ID)),
+            self.header, self.utm, memory=args.treememory * 2**20,
+            max_open=args.treefiles)
+
+    def _save_tree_points(self, chunk,
+                          trees: pointcloudfile.PartitionWriter) -> None:
+        """Pass the points in each tree to the writer for trees."""
+        vals = self.raster.get('trees', *chunk_coords(chunk))
+        trees.write(vals[vals >= 0], chunk[vals >= 0])
+
+    def save_all(self, new_fname):
+        """Save the sparse point cloud, accumulate colours, and save single
+        trees to files, in one pass over the points spilled while reading.
+
+        This is equivalent to calling :py:meth:`save_sparse_cloud`,
+        :py:meth:`update_colours`, and :py:meth:`save_individual_trees` in
+        turn, but does not read the input file again.
+        """
+        if self.spill is None:
+            raise ValueError('Points were not spilled; use spill=True')
+        with profiling.stage('save_all') as record:
+            sparse = pointcloudfile.IncrementalWriter(
+                new_fname, self.header, self.utm, codec=args.compress,
+                scale=args.precision)
+            trees = self._tree_writer() if args.savetrees else None
+            self.spill.seek(0)
+            for chunk in self._spilled_chunks():
+                record['points'] += chunk.size
+                chunk = chunk[self._sparse(chunk)]
+                sparse.extend(chunk)
+                self._add_colours(chunk)
+                if trees is not None:
+                    self._save_tree_points(chunk, trees)
+            sparse.close()
+            if trees is not None:
+                trees.close()
+        self.spill.close()
+        self.spill = None
+        self.file = new_fname
+
+    def _spill(self, chunk, offset) -> None:
+        """Copy a chunk of points from a part with the given offset to the
+        spill file.
+
+        Points are stored as in a binary file, with float32 coordinates
+        relative to the offset, unless that would change them (eg. for
+        ``.las`` input); then the chunk is stored as it is.
+        """
+        self.spill_dtype = chunk.dtype
+        stored = pointcloudfile.vertex_dtype(self.header).newbyteorder('=')
+        records = np.empty(chunk.shape, stored)
+        for name in chunk.dtype.names:
+            records[name] = chunk[name]
+        for n, name in enumerate('xyz'):
+            records[name] = chunk[name] - offset[n]
+            if not np.array_equal(
+                    records[name].astype(np.float64) + offset[n], chunk[name]):
+                records, offset = chunk, (0, 0, 0)
+                break
+        self.spill.write(records.tobytes())
+        self.spilled.append((records.dtype, offset, records.size))
+
+    def _spilled_chunks(self):
+        """Yield chunks of points from the spill file, as they were read."""
+        for stored, offset, count in self.spilled:
+            records = np.frombuffer(self.spill.read(count * stored.itemsize),
+                                    dtype=stored)
+            chunk = np.empty(count, self.spill_dtype)
+            for name in chunk.dtype.names:
+                chunk[name] = records[name]
+            for n, name in enumerate('xyz'):
+                chunk[name] += offset[n]
+            yield chunk
+
+    def stream_analysis(self, out: str) -> int:
+        """ Save the list of trees with attributes to the file 'out', and
+        return the number of trees.
+
+        The table is written to a temporary file, which replaces 'out' only
+        when complete - so a failed analysis never leaves a table.
         """
         header = ('latitude', 'longitude', 'UTM_X', 'UTM_Y', 'UTM_zone',
-                  'height', 'area', 'base_altitude', 'point_count') + tuple(
-                      a for a in self.header.names if a not in 'xyz')
-        with open(out, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=header)
-            writer.writeheader()
-            for data in self.all_trees():
-                writer.writerow(data)
-
-
-def get_args():
+                  'height', 'area', 'base_altitude', 'point_count'
+                 ) + self.colours
+        temp = out + '.tmp'
+        try:
+            with profiling.stage('analysis', len(self)), \
+                    open(temp, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=header)
+                writer.writeheader()
+                count = 0
+                for data in self.all_trees():
+                    writer.writerow(data)
+                    count += 1
+        except BaseException:
+            os.remove(temp)
+            raise
+        os.replace(temp, out)
+        return count
+
+
+def float_list(text: str) -> List[float]:
+    """Parse a comma-separated list of numbers, eg. ``0.4,0.6``, for an
+    option with several values to sweep over."""
+    try:
+        return [float(value) for value in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected numbers separated by commas, not ' + repr(text)
+        ) from None
+
+
+def get_args(argv=None):
     """ Handle command-line arguments, including default values.
+    Arguments are read from argv if given, or from sys.argv.
     """
     parser = argparse.ArgumentParser(
         description=('Takes a .ply forest  point cloud; outputs a sparse'
@@ -345,58 +571,179 @@ def get_args():
         '--north', action='store_true',
         help='set if in the northern hemisphere')
     parser.add_argument(  # feature extraction
-        '--joinedcells', default=3, type=float,
-        help='use cells X times larger to detect gaps between trees')
+        '--joinedcells', default=[3], type=float_list,
+        help=('use cells X times larger to detect gaps between trees; '
+              'several values separated by commas to sweep over'))
     parser.add_argument(  # feature extraction
-        '--slicedepth', default=0.6, type=float,
-        help='slice depth for canopy area and feature extraction')
+        '--slicedepth', default=[0.6], type=float_list,
+        help=('slice depth for canopy area and feature extraction; '
+              'several values separated by commas to sweep over'))
     parser.add_argument(  # feature classification
         '--grounddepth', default=0.2, type=float,
         help='depth to omit from sparse point cloud')
-    return parser.parse_args()
+    parser.add_argument(  # output format
+        '--compress', default='', choices=sorted(pointcloudfile.CODECS),
+        help='compress the sparse point cloud (default not compressed)')
+    parser.add_argument(  # output format
+        '--precision', default=0.001, type=float,
+        help='precision of coordinates in a compressed sparse point cloud')
+    parser.add_argument(  # performance
+        '--workers', default=1, type=int,
+        help='number of processes for reading, smoothing, and tree detection')
+    parser.add_argument(  # performance
+        '--pipeline', action='store_true',
+        help='read the input only once, spilling points to a temporary file')
+    parser.add_argument(  # performance
+        '--treememory', default=64, type=int,
+        help='megabytes of points to buffer when saving trees (default 64)')
+    parser.add_argument(  # performance
+        '--treefiles', default=64, type=int,
+        help='temporary files to use when saving trees (default 64)')
+    parser.add_argument(  # performance
+        '--readbuffer', default=8, type=int,
+        help='megabytes to read ahead at a time (default 8)')
+    parser.add_argument(  # performance
+        '--readdepth', default=3, type=int,
+        help='buffers to read ahead, 2 for double buffering (default 3)')
+    parser.add_argument(  # performance
+        '--nocache', action='store_true',
+        help='do not load or save the map cache, <input>_raster.npz')
+    parser.add_argument(  # performance
+        '--profile', action='store_true',
+        help='save time and resources used by each stage to a .json file')
+    namespace = parser.parse_args(argv)
+    # Several values for tree detection are swept over, after a run with
+    # the first value of each
+    namespace.sweep = list(itertools.product(
+        namespace.slicedepth, namespace.joinedcells))
+    namespace.slicedepth = namespace.slicedepth[0]
+    namespace.joinedcells = namespace.joinedcells[0]
+    return namespace
+
+
+def output_files(fname: str, out: str) -> Tuple[str, str]:
+    """Return the names of the sparse cloud and analysis table for the
+    input file fname, in the directory out."""
+    # Set output file name to <input file name>_sparse.ply
+    sparse = os.path.join(out, os.path.basename(fname))
+    if not fname.endswith('_sparse.ply'):
+        sparse = os.path.join(
+            out, pointcloudfile.stem(os.path.basename(fname)) + '_sparse.ply')
+    sparse = sparse.replace('_part_1', '')
+    table = '{}_analysis.csv'.format(sparse[:-4].replace('_sparse', ''))
+    return sparse, table
+
+
+def cache_key(fname: str) -> dict:
+    """Return the key for a cached map of fname, with the size and
+    modification time of each input file and the arguments which affect
+    the map before trees are detected."""
+    return {
+        'version': 1,
+        'input': os.path.abspath(fname),
+        'files': [[os.path.getsize(f), os.stat(f).st_mtime_ns]
+                  for f in pointcloudfile.pix4d_parts(fname)],
+        'cellsize': args.cellsize,
+        'grounddepth': args.grounddepth,
+        }
 
 
 def main_processing():
     """ Logic on which functions to call, and efficient order.
+    With ``--profile``, also save the time and resources used by each stage
+    to ``<input>_profile.json`` beside the analysis.
     """
+    if not args.profile:
+        _main_processing()
+        return
+    with profiling.Profile() as prof:
+        table = _main_processing()
+    report = table[:-len('_analysis.csv')] + '_profile.json'
+    print('Saving profile to ' + report)
+    prof.save(report, input=args.file, args=vars(args))
+
+
+def _main_processing() -> str:
+    """Run the analysis, and return the name of the analysis table."""
     # args is a global variable
     print('Reading from "{}" ...'.format(args.file))
 
     # File I/O
-
-    # Set output file name to <input file name>_sparse.ply
-    sparse = os.path.join(args.out, os.path.basename(args.file))
-    if not args.file.endswith('_sparse.ply'):
-        sparse = os.path.join(
-            args.out, os.path.basename(args.file)[:-4] + '_sparse.ply')
-    sparse = sparse.replace('_part_1', '')
-    if os.path.isfile(sparse):
+    sparse, table = output_files(args.file, args.out)
+    trees_saved = False
+    from_input = True
+    cache = sparse[:-4].replace('_sparse', '') + '_raster.npz'
+    key = cache_key(args.file)
+    cached = None
+    if os.path.isfile(sparse) and not args.nocache:
+        cached = MapObj.load(cache, sparse, key)
+    if cached is not None:
+        attr_map = cached
+        print('Loaded {} points in {} cells from "{}"'.format(
+            len(attr_map), attr_map.cell_count, cache))
+    elif os.path.isfile(sparse):
         attr_map = MapObj(sparse)
+        # Not cached, as a map of the sparse cloud differs from the input
+        from_input = False
         print('Read {} points into {} cells'.format(
-            len(attr_map), len(attr_map.canopy)))
+            len(attr_map), attr_map.cell_count))
+    elif args.pipeline:
+        attr_map = MapObj(args.file, colours=False, spill=True)
+        print('Read {} points into {} cells, writing "{}" ...'.format(
+            len(attr_map), attr_map.cell_count, sparse))
+        attr_map.save_all(sparse)
+        trees_saved = True
     else:
         attr_map = MapObj(args.file, colours=False)
         print('Read {} points into {} cells, writing "{}" ...'.format(
-            len(attr_map), len(attr_map.canopy), sparse))
+            len(attr_map), attr_map.cell_count, sparse))
         attr_map.save_sparse_cloud(sparse)
-        print('Reading colours from ' + sparse)
+        print('Reading colours from ' + attr_map.file)
         attr_map.update_colours()
+    if cached is None and from_input and not args.nocache:
+        attr_map.save(cache, key)
+    print('Ground smoothing converged after {} iterations'.format(
+        attr_map.smoothing_iterations))
     print('File IO complete, starting analysis...')
 
-    table = '{}_analysis.csv'.format(sparse[:-4].replace('_sparse', ''))
+    if len(args.sweep) > 1:
+        print('Detecting trees with {} combinations of options...'.format(
+            len(args.sweep)))
+        with profiling.stage('sweep', len(attr_map) * len(args.sweep)):
+            summary = sweep(attr_map, table)
+        print('Saved tree counts to "{}".'.format(summary))
+    # The usual table is for the first value of each option
     attr_map.stream_analysis(table)
-    if args.savetrees:
+    if args.savetrees and len(args.sweep) > 1:
+        if trees_saved:
+            print('Individual trees were saved with only the first values, '
+                  'slicedepth {:g} and joinedcells {:g}.'.format(
+                      args.slicedepth, args.joinedcells))
+        else:
+            print('Individual trees are not saved when sweeping options.')
+    elif args.savetrees and not trees_saved:
         print('Saving individual trees...')
         attr_map.save_individual_trees()
     print('Done.')
+    return table
+
+
+# Operations other than analysis, by the first command-line argument; each
+# is the main function of the module of that name in this package
+COMMANDS = ('batch', 'reorder')
 
 
 def main():
     """ Interface to call from outside the package.
+    ``forestutils reorder ...`` runs :py:func:`src.reorder.main`, and
+    ``forestutils batch ...`` runs :py:func:`src.batch.main`, instead.
     """
-    # pylint:disable=global-statement
-    global args
-    args = get_args()
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        # Imported by name, as batch imports this module
+        command = importlib.import_module('.' + sys.argv[1], __package__)
+        command.main(sys.argv[2:])
+        return
+    _set_args(get_args())
     if not os.path.isfile(args.file):
         raise IOError('Input file not found, ' + args.file)
     # Check that 'out' is a valid folder BEFORE doing all the processing
@@ -409,5 +756,6 @@ if __name__ == '__main__':
     # Call to get_args is duplicated to work in static analysis, from
     # command line, and when installed as package (calls main directly)
     print('Welcome to forestutils tree analysis software')
-    args = get_args()
+    if not (sys.argv[1:2] and sys.argv[1] in COMMANDS):
+        args = get_args()
     main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""Smoothing the ground and labelling trees over a raster of cells.
+
+These operate on the 'ground' and 'canopy' layers of a
+:py:class:`~src.raster.Raster`, as built by :py:mod:`~src.forestutils`, and
+take the cell size, slice depth, and size of larger cells as arguments.
+:py:func:`tiled_analysis` does the same in tiles on parallel processes, for
+huge sites.
+"""
+# pylint:disable=unsubscriptable-object,invalid-sequence-index
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+from .raster import Raster
+
+
+# The most iterations of ground smoothing
+SMOOTHING_ITERATIONS = 100
+
+
+def neighbors(array: np.ndarray, i: np.ndarray, j: np.ndarray,
+              fill) -> np.ndarray:
+    """ Take arrays of indices into array and return an array of the values
+    of the eight adjacent cells of each, with fill for those outside array.
+    """
+    padded = np.pad(array, 1, mode='constant', constant_values=fill)
+    return np.stack([padded[i + 1 + a, j + 1 + b]
+                     for a in (-1, 0, 1) for b in (-1, 0, 1) if a or b],
+                    axis=-1)
+
+
+def union_find(size: int, first: np.ndarray,
+               second: np.ndarray) -> np.ndarray:
+    """Return the root of each of ``size`` elements, after joining each
+    element of first with the corresponding element of second.
+
+    Uses a vectorised union-find: each pass hooks the root of every pair
+    with different roots onto the smaller root, then compresses paths until
+    every element points directly to its root.  This takes near-linear
+    time, and the root of each set is always its smallest element.
+    """
+    parent = np.arange(size)
+    while True:
+        root_a, root_b = parent[first], parent[second]
+        differ = root_a != root_b
+        if not differ.any():
+            return parent
+        np.minimum.at(parent, np.maximum(root_a, root_b)[differ],
+                      np.minimum(root_a, root_b)[differ])
+        grandparent = parent[parent]
+        while (grandparent != parent).any():
+            parent = grandparent
+            grandparent = parent[parent]
+
+
+def connected_components(labels: np.ndarray) -> None:
+    """ Connected components in an array of labels, updated in place.
+    Every cell of a component (including diagonal neighbours) is given the
+    smallest label in that component.  Non-component cells are negative.
+
+    Uses :py:func:`union_find` over all pairs of adjacent cells, so the
+    result does not depend on the order in which cells are visited.
+    """
+    i, j = np.nonzero(labels >= 0)
+    index = np.full(labels.shape, -1, dtype=np.int64)
+    index[i, j] = np.arange(i.size)
+    # Pairs of adjacent cells; with their reverse these cover all neighbours
+    rows, cols = labels.shape
+    first, second = [], []
+    for di, dj in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        a = index[:rows - di, max(0, -dj):cols - max(0, dj)]
+        b = index[di:, max(0, dj):cols - max(0, -dj)]
+        both = (a >= 0) & (b >= 0)
+        first.append(a[both])
+        second.append(b[both])
+    parent = union_find(i.size, np.concatenate(first), np.concatenate(second))
+    # Relabel each component with the smallest label of its cells
+    smallest = np.full(i.size, np.iinfo(labels.dtype).max, labels.dtype)
+    np.minimum.at(smallest, parent, labels[i, j])
+    labels[i, j] = smallest[parent]
+
+
+def detect_issues(ground: np.ndarray, prior: np.ndarray,
+                  cellsize: float) -> np.ndarray:
+    """Identifies cells with more than 2:1 slope to 3+ adjacent cells.
+    Only cells where prior is true are checked; empty cells have a ground
+    value of +inf.  Returns a boolean array of problematic cells.
+    """
+    i, j = np.nonzero(prior)
+    # Distinct finite values of the adjacent cells; sorting puts equal
+    # values together and empty cells last.
+    adjacent = np.sort(neighbors(ground, i, j, np.inf), axis=-1)
+    distinct = np.isfinite(adjacent)
+    distinct[:, 1:] &= adjacent[:, 1:] != adjacent[:, :-1]
+    # Number of cells at more than 2:1 slope - suspiciously steep.
+    # 3+ usually indicates a misclassified cell or data artefact.
+    steep = np.abs(ground[i, j, None] - adjacent) > 2*cellsize
+    probs = np.count_nonzero(distinct & steep, axis=-1)
+    problematic = np.zeros(ground.shape, dtype=bool)
+    problematic[i, j] = (np.count_nonzero(distinct, axis=-1) >= 6) & (
+        probs >= 3)
+    return problematic
+
+
+def smoothing_step(ground: np.ndarray, problematic: np.ndarray,
+                   cellsize: float
+                   ) -> Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """Make one iteration of :py:func:`smooth_ground`, changing ground in
+    place.  Only cells where problematic is true are checked.
+
+    Returns the cells which are still problematic, and the indices of the
+    cells which changed.
+    """
+    problematic = detect_issues(ground, problematic, cellsize)
+    i, j = np.nonzero(problematic)
+    # Lowest adjacent cell which is neither empty nor problematic
+    adjacent = np.where(neighbors(problematic, i, j, False), np.inf,
+                        neighbors(ground, i, j, np.inf)).min(axis=-1)
+    fixable = np.isfinite(adjacent)
+    i, j = i[fixable], j[fixable]
+    new = adjacent[fixable] + 2*cellsize
+    moved = ground[i, j] != new
+    ground[i, j] = new
+    return problematic, (i[moved], j[moved])
+
+
+def smooth_ground(ground: np.ndarray, cellsize: float) -> int:
+    """Smooths the ground map, to reduce the impact of spurious points, eg.
+    points far underground or misclassification of canopy as ground.
+
+    Empty cells have a ground value of +inf.  Stops when an iteration does
+    not change the map, and returns the number of iterations which did.
+    """
+    problematic = ground < np.inf
+    for iteration in range(SMOOTHING_ITERATIONS):
+        problematic, (i, _) = smoothing_step(ground, problematic, cellsize)
+        if not i.size:
+            return iteration
+    return SMOOTHING_ITERATIONS
+
+
+def big_cells(raster: Raster, i: np.ndarray, j: np.ndarray,
+              joinedcells: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the coordinates of the larger cells, used to detect gaps
+    between trees, for the raster cells at indices i, j.
+    """
+    x, y = raster.coords(i, j)
+    return (np.floor(x / joinedcells).astype(np.int64),
+            np.floor(y / joinedcells).astype(np.int64))
+
+
+def big_cell_ids(big_x: np.ndarray, big_y: np.ndarray) -> np.ndarray:
+    """Number the distinct larger cells in order of their coordinates,
+    and return the number of the larger cell at each position."""
+    if not big_x.size:
+        return np.zeros(0, dtype=np.int32)
+    big_x, big_y = big_x - big_x.min(), big_y - big_y.min()
+    flat = np.ravel_multi_index(
+        (big_x, big_y), (big_x.max() + 1, big_y.max() + 1))
+    return np.unique(flat, return_inverse=True)[1].reshape(-1).astype(
+        np.int32)
+
+
+def tree_components(raster: Raster, slicedepth: float,
+                    joinedcells: float) -> np.ndarray:
+    """Returns an array of labels for connected components in each cell.
+    NB: Cells which are not part of any component are labelled -1.
+    """
+    # Find the larger keys to search for each cell with canopy
+    canopy = raster['canopy'] - raster['ground']
+    i, j = np.nonzero(canopy > slicedepth)
+    labels = np.full(raster.shape, -1, dtype=np.int32)
+    if not i.size:
+        return labels
+    big_x, big_y = big_cells(raster, i, j, joinedcells)
+    big_x -= big_x.min() - 1
+    big_y -= big_y.min() - 1
+    # Assign a unique integer value to each large key, then search
+    # Final labels are positive ints, but not ordered or consecutive
+    trees = np.full((big_x.max() + 2, big_y.max() + 2), -1, np.int32)
+    trees[big_x, big_y] = big_cell_ids(big_x, big_y)
+    connected_components(trees)
+    # Copy labels to grid of original scale
+    labels[i, j] = trees[big_x, big_y]
+    return labels
+
+
+def _smooth_tile(tile: Raster, smooth_halo: int, steps: int,
+                 cellsize: float) -> Tuple[int, Raster]:
+    """Make up to ``steps`` smoothing iterations over a tile of the map,
+    with 'ground' and 'problematic' layers as in :py:func:`smoothing_step`.
+
+    Returns the number of iterations which changed the core of the tile
+    (all but the outer ``smooth_halo`` cells), and the core as it is after
+    every iteration.
+    """
+    ground, problematic = tile['ground'], tile['problematic']
+    last = tuple(n - smooth_halo for n in ground.shape)
+    changed = 0
+    for step in range(steps):
+        problematic, (i, j) = smoothing_step(ground, problematic, cellsize)
+        if not i.size:
+            # Nothing changed, so neither will further iterations
+            break
+        if ((i >= smooth_halo) & (i < last[0]) &
+                (j >= smooth_halo) & (j < last[1])).any():
+            changed = step + 1
+    tile['problematic'] = problematic
+    return changed, tile.crop(
+        (tile.origin[0] + smooth_halo, tile.origin[1] + smooth_halo),
+        (last[0] - smooth_halo, last[1] - smooth_halo))
+
+
+def _label_tile(tile: Raster, slicedepth: float,
+                joinedcells: float) -> Raster:
+    """Return the tile with tree labels in 'trees', numbered consecutively
+    from zero."""
+    labels = tree_components(tile, slicedepth, joinedcells)
+    labels[labels >= 0] = np.unique(
+        labels[labels >= 0], return_inverse=True)[1].reshape(-1)
+    tile['trees'] = labels
+    return tile
+
+
+def _label_halo(joinedcells: float) -> int:
+    """Return the width of halo which contains any larger cell adjacent to
+    a tile."""
+    return int(math.ceil(2 * joinedcells)) + 1
+
+
+def _cores(raster: Raster, tile_size: int) -> List[Tuple[int, int]]:
+    """Return the indices of the first cell in the core of each tile."""
+    return [(x, y) for x in range(0, raster.shape[0], tile_size)
+            for y in range(0, raster.shape[1], tile_size)]
+
+
+def _tiles(raster: Raster, cores: list, tile_size: int, halo: int,
+           names: Tuple[str, ...]):
+    """Yield a tile of the named layers for each core, with a halo."""
+    for x, y in cores:
+        yield raster.crop(
+            (raster.origin[0] + x - halo, raster.origin[1] + y - halo),
+            (min(tile_size, raster.shape[0] - x) + 2 * halo,
+             min(tile_size, raster.shape[1] - y) + 2 * halo), names)
+
+
+def _smooth_in_tiles(raster: Raster, pool: ProcessPoolExecutor,
+                     tile_size: int, smooth_halo: int,
+                     cellsize: float) -> int:
+    """Smooth the 'ground' layer of the raster in tiles, on the pool, and
+    return the number of smoothing iterations, as for :py:func:`smooth_ground`.
+
+    Changes to the ground propagate at most two cells per iteration, so the
+    core of each tile is exact for ``smooth_halo // 2 - 1`` iterations.
+    Tiles are smoothed for that many iterations at a time, and their cores
+    copied back to the raster, until the ground converges.  Tiles with no
+    problematic cells in the core can not change, so are skipped.
+    """
+    state = raster.crop(raster.origin, raster.shape, ('ground',))
+    state['problematic'] = raster['ground'] < np.inf
+    iterations = 0
+    while iterations < SMOOTHING_ITERATIONS:
+        steps = min(smooth_halo // 2 - 1, SMOOTHING_ITERATIONS - iterations)
+        todo = [(x, y) for x, y in _cores(raster, tile_size)
+                if state['problematic'][x:x + tile_size,
+                                        y:y + tile_size].any()]
+        results = list(pool.map(
+            _smooth_tile,
+            _tiles(state, todo, tile_size, smooth_halo,
+                   ('ground', 'problematic')),
+            itertools.repeat(smooth_halo), itertools.repeat(steps),
+            itertools.repeat(cellsize)))
+        for (x, y), (_, tile) in zip(todo, results):
+            core = (slice(x, x + tile.shape[0]), slice(y, y + tile.shape[1]))
+            state['ground'][core] = tile['ground']
+            state['problematic'][core] = tile['problematic']
+        changed = max((n for n, _ in results), default=0)
+        iterations += changed
+        if changed < steps:
+            # An iteration changed no tile, so the ground has converged
+            break
+    raster['ground'] = state['ground']
+    return iterations
+
+
+def tiled_analysis(raster: Raster, options: argparse.Namespace,
+                   tile_size: int=1024, smooth_halo: int=32) -> int:
+    """Smooth the ground and label trees in tiles, in parallel processes.
+
+    Gives the same result as :py:func:`smooth_ground` and
+    :py:func:`tree_components` on the whole raster, with the ``workers``,
+    ``cellsize``, ``slicedepth``, and ``joinedcells`` of options.  The
+    ground is smoothed by :py:func:`_smooth_in_tiles`, then labels are
+    stitched across tiles using the overlapping halos, which are wide
+    enough to contain any larger cell adjacent to a tile.
+
+    Sets the 'ground' and 'trees' layers of the raster, and returns the
+    number of smoothing iterations.
+    """
+    label_halo = _label_halo(options.joinedcells)
+    if not all(raster.shape):
+        raster['trees'] = np.full(raster.shape, -1, dtype=np.int32)
+        return 0
+    tile_size = max(
+        min(tile_size, -(-max(raster.shape) // options.workers)),
+        smooth_halo, label_halo)
+    cores = _cores(raster, tile_size)
+    with ProcessPoolExecutor(options.workers) as pool:
+        iterations = _smooth_in_tiles(
+            raster, pool, tile_size, smooth_halo, options.cellsize)
+        tiles = list(pool.map(
+            _label_tile,
+            _tiles(raster, cores, tile_size, label_halo,
+                   ('canopy', 'ground')),
+            itertools.repeat(options.slicedepth),
+            itertools.repeat(options.joinedcells)))
+    _stitch_tiles(raster, cores, tiles, tile_size, options.joinedcells)
+    return iterations
+
+
+def _stitch_tiles(raster: Raster, cores: list, tiles: list,
+                  tile_size: int, joinedcells: float) -> None:
+    """Set tree labels in raster from the tiles labelled by
+    :py:func:`tiled_analysis`, joining trees which span tiles."""
+    # pylint:disable=too-many-locals
+    label_halo = _label_halo(joinedcells)
+    # Collect the label of each cell in the core of any tile and the halos
+    # of all other tiles
+    owner = np.full(raster.shape, -1, dtype=np.int64)
+    offset = 0
+    for (x, y), tile in zip(cores, tiles):
+        core = (slice(x, x + tile_size), slice(y, y + tile_size))
+        inner = tuple(slice(label_halo, n - label_halo) for n in tile.shape)
+        labels = tile['trees'][inner]
+        owner[core] = np.where(labels >= 0, labels + offset, -1)
+        offset += int(tile['trees'].max()) + 1
+    first, second = [], []
+    offset = 0
+    for tile in tiles:
+        i, j = np.nonzero(tile['trees'] >= 0)
+        first.append(owner[raster.index(*tile.coords(i, j))])
+        second.append(tile['trees'][i, j] + offset)
+        offset += int(tile['trees'].max()) + 1
+    parent = union_find(offset, np.concatenate(first),
+                        np.concatenate(second))
+
+    # Number trees as if labelled in one piece, by the first larger cell
+    i, j = np.nonzero(owner >= 0)
+    tree = parent[owner[i, j]]
+    smallest = np.full(offset, np.iinfo(np.int32).max, dtype=np.int32)
+    np.minimum.at(smallest, tree,
+                  big_cell_ids(*big_cells(raster, i, j, joinedcells)))
+    raster['trees'] = np.full(raster.shape, -1, dtype=np.int32)
+    raster['trees'][i, j] = smallest[tree]
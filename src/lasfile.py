@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Reading of LiDAR point clouds in the LAS format, versions 1.0 to 1.4.
+
+:py:mod:`~src.pointcloudfile` reads ``.las`` files with this module, so
+they can be used anywhere a ``.ply`` file can.  Points are returned with
+x, y, and z in metres, relative to an origin at the south-west corner of
+the bounding box (see :py:func:`origin`), and red, green, and blue as
+8-bit values if the point format includes colour.  Other attributes, such
+as intensity and classification, are ignored.
+
+Point formats 0 to 3 and 6 to 8 are supported.  Compressed ``.laz`` files
+are not; decompress them with eg. ``laszip`` first.  The UTM zone is not
+read from the file, so must be given as for ``.ply`` files.
+"""
+# pylint:disable=unsubscriptable-object,invalid-sequence-index
+
+import functools
+import os
+import struct
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+LasHeader = NamedTuple('LasHeader', [
+    ('version', Tuple[int, int]), ('point_format', int),
+    ('record_length', int), ('point_offset', int), ('count', int),
+    ('scale', Tuple[float, float, float]),
+    ('offset', Tuple[float, float, float]),
+    ('mins', Tuple[float, float, float])])
+
+# The fields of the public header block which are used: the signature,
+# version, offset to points, point format, record length, legacy point
+# count, and the scale, offset, and range of coordinates
+_HEADER = struct.Struct('<4s20xBB64x4x2xI4xBHI20x3d3d6d')
+_COUNT_14 = struct.Struct('<Q')
+_COUNT_14_OFFSET = 247
+# The offset of the red, green, and blue fields for each point format
+RGB_OFFSETS = {0: None, 1: None, 2: 20, 3: 28, 6: None, 7: 30, 8: 30}
+
+
+def is_las(fname: str) -> bool:
+    """Return whether fname is a LAS file, by the extension."""
+    return fname.endswith('.las')
+
+
+def read_las_header(fname: str) -> LasHeader:
+    """Return the fields of the header of a LAS file needed to read points.
+
+    Raises:
+        ValueError: if the file is not a LAS file, the points are
+            compressed, or the point format is not supported.
+    """
+    with open(fname, 'rb') as f:
+        raw = f.read(_COUNT_14_OFFSET + _COUNT_14.size)
+    if len(raw) < _HEADER.size:
+        raise ValueError('Not a valid .las file (too short): ' + fname)
+    fields = _HEADER.unpack_from(raw)
+    (signature, major, minor, point_offset, point_format, record_length,
+     count) = fields[:7]
+    if signature != b'LASF':
+        raise ValueError('Not a valid .las file (wrong signature): ' + fname)
+    # Bits 6 and 7 flag compressed (.laz) data
+    if point_format & 0xc0:
+        raise ValueError('LAZ-compressed .las is not supported: ' + fname)
+    if point_format not in RGB_OFFSETS:
+        raise ValueError('LAS point format {} is not supported: {}'.format(
+            point_format, fname))
+    if (major, minor) >= (1, 4) and len(raw) == _COUNT_14_OFFSET + 8:
+        count = _COUNT_14.unpack_from(raw, _COUNT_14_OFFSET)[0] or count
+    # Maximum and minimum coordinates alternate
+    return LasHeader((major, minor), point_format, record_length,
+                     point_offset, count, fields[7:10], fields[10:13],
+                     fields[14:19:2])
+
+
+def record_dtype(header: LasHeader) -> np.dtype:
+    """Return the Numpy dtype of the point records that are read."""
+    names, formats, offsets = ['X', 'Y', 'Z'], ['<i4'] * 3, [0, 4, 8]
+    rgb = RGB_OFFSETS[header.point_format]
+    if rgb is not None:
+        names += ['R', 'G', 'B']
+        formats += ['<u2'] * 3
+        offsets += [rgb, rgb + 2, rgb + 4]
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': header.record_length})
+
+
+def origin(header: LasHeader) -> Tuple[float, float, float]:
+    """Return the UTM origin of points, as for
+    :py:func:`~src.pointcloudfile.offset_for`.
+
+    This is the whole metre south-west of all points, so that coordinates
+    relative to the origin are small enough to store as float32.  Heights
+    are not offset.
+    """
+    return (float(np.floor(header.mins[0])), float(np.floor(header.mins[1])),
+            0.0)
+
+
+@functools.lru_cache()
+def _rgb_shift(fname: str, mtime_ns: int) -> int:
+    """Return the bits to shift colours right to get 8-bit values.
+
+    The LAS format specifies 16-bit colours, but some files store 8-bit
+    values.  This is detected from the colours of the first points.
+    """
+    # pylint:disable=unused-argument
+    header = read_las_header(fname)
+    dtype = record_dtype(header)
+    with open(fname, 'rb') as f:
+        f.seek(header.point_offset)
+        sample = np.frombuffer(f.read(dtype.itemsize * min(
+            header.count, 2**16)), dtype=dtype)
+    if not sample.size:
+        return 8
+    return 8 if max(sample[c].max() for c in 'RGB') > 255 else 0
+
+
+def decode(records: np.ndarray, header: LasHeader, fname: str,
+           out_dtype: np.dtype) -> np.ndarray:
+    """Return the points in records from fname as an array of out_dtype, as
+    for :py:func:`~src.pointcloudfile.read_chunks`."""
+    out = np.empty(records.shape, out_dtype)
+    base = origin(header)
+    for n, (name, field) in enumerate(zip('xyz', 'XYZ')):
+        # Scale in float64, then shift to the origin; both are exact enough
+        out[name] = records[field] * header.scale[n]
+        out[name] += header.offset[n] - base[n]
+    if 'red' in (out_dtype.names or ()):
+        shift = _rgb_shift(fname, os.stat(fname).st_mtime_ns)
+        for name, field in zip(('red', 'green', 'blue'), 'RGB'):
+            out[name] = records[field] >> shift
+    return out
@@ -3,11 +3,24 @@
 
 Most uses of this module should go through :py:func:`read` to iterate over
 points in the file, or :py:func:`write` to save an iterable of points.
-Neither function accumulates much data in memory.
+Neither function accumulates much data in memory.  :py:func:`read_chunks`
+yields the same points as Numpy structured arrays, for vectorised processing
+of many points at once, and :py:func:`open_mmap` maps the vertices of a file
+for random access without reading them.  :py:func:`map_ranges` reads
+separate ranges of vertices in parallel.  All reads of vertices are done
+ahead on a background thread, as configured by :py:class:`ReadAhead`.
+
+Writers can optionally store coordinates quantized to a fixed precision and
+compressed in blocks (see :py:class:`IncrementalWriter`).  Such files are
+read as usual, except by :py:func:`open_mmap`.  Whole files compressed with
+gzip or xz (``.ply.gz`` or ``.ply.xz``) are also read as usual, decompressing
+them as a stream, and so are LiDAR ``.las`` files (see :py:mod:`~src.lasfile`).
 
 :py:class:`IncrementalWriter` is useful when accumulating data in memory to
-write many files is impractical.  :py:func:`offset_for` and
-:py:func:`read_header` provide location metadata if possible.
+write many files is impractical, and :py:class:`PartitionWriter` splits a
+cloud into many files with bounded memory and open files.
+:py:func:`offset_for` and :py:func:`read_header` provide location metadata
+if possible.
 
 In all cases a "point" is tuple of (x, y, z, r, g, b).  XYZ are floats denoting
 spatial coordinates.  RGB is the color, each an unsigned 8-bit integer.
@@ -16,13 +29,25 @@ format easily enough.
 """
 # Pylint can freak out about mypy type notation; it's fine at runtime
 # pylint:disable=unsubscriptable-object,invalid-sequence-index
+# pylint:disable=too-many-lines
 
 from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+import gzip
 import itertools
+import lzma
+import queue
 import struct
 import os.path
-from tempfile import SpooledTemporaryFile
-from typing import Iterator, List, NamedTuple, Tuple
+import threading
+from tempfile import SpooledTemporaryFile, TemporaryFile
+from typing import (Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Tuple)
+import zlib
+
+import numpy as np
+
+from . import lasfile
 
 
 # User-defined types:
@@ -32,15 +57,54 @@ PlyHeader = NamedTuple('PlyHeader', [
     ('form_str', str), ('comments', Tuple[str, ...])])
 UTM_Coord = NamedTuple('UTM_Coord', [
     ('x', float), ('y', float), ('zone', int), ('north', bool)])
+VertexRange = NamedTuple('VertexRange', [
+    ('fname', str), ('start', int), ('stop', int),
+    ('offset', Tuple[float, float, float])])
 
 # The various struct types of .ply binary format
 PLY_TYPES = {'float': 'f', 'double': 'd', 'uchar': 'B', 'char': 'b',
              'ushort': 'H', 'short': 'h', 'uint': 'I', 'int': 'i'}
 
+# Codecs for compressed files, as (compress, decompress) functions
+CODECS = {'zlib': (zlib.compress, zlib.decompress),
+          'lzma': (lzma.compress, lzma.decompress)
+          }  # type: Dict[str, Tuple[Callable, Callable]]
+# Each compressed block starts with the number of points and of bytes.
+# Within a block, the nth bytes of all records are stored together, as
+# they are similar and compress much better than whole records.
+BLOCK_HEAD = struct.Struct('>II')
+# Functions to open compressed input files, by the suffix after .ply
+STREAM_CODECS = {
+    '.gz': gzip.open, '.xz': lzma.open}  # type: Dict[str, Callable]
+
+
+def _is_stream(fname: str) -> bool:
+    """Return whether fname is a compressed file, eg. ``.ply.gz``."""
+    return fname[-3:] in STREAM_CODECS and fname[:-3].endswith('.ply')
+
+
+def _open(fname: str, raw: bool=False):
+    """Open fname for reading bytes, decompressing it if it is a compressed
+    file.  Uncompressed files are unbuffered if raw is true."""
+    if _is_stream(fname):
+        return STREAM_CODECS[fname[-3:]](fname, 'rb')
+    return open(fname, 'rb', buffering=0 if raw else -1)
+
+
+def stem(fname: str) -> str:
+    """Return fname without the extension, or extension and compression
+    suffix of a compressed file, eg. ``cloud`` from ``cloud.ply.gz``."""
+    if _is_stream(fname):
+        fname = fname[:-3]
+    return os.path.splitext(fname)[0]
+
 
 def offset_for(filename: str) -> Tuple[float, float, float]:
-    """Return the (x, y, z) UTM offset for a Pix4D or forestutils .ply file."""
-    offset = filename[:-4] + '_ply_offset.xyz'
+    """Return the (x, y, z) UTM offset for a Pix4D or forestutils .ply file,
+    or a .las file."""
+    if lasfile.is_las(filename):
+        return lasfile.origin(lasfile.read_las_header(filename))
+    offset = stem(filename) + '_ply_offset.xyz'
     if os.path.isfile(offset):
         with open(offset) as f:
             x, y, z = tuple(float(n) for n in f.readline().strip().split(' '))
@@ -52,30 +116,63 @@ def offset_for(filename: str) -> Tuple[float, float, float]:
 
 
 def _check_input(fname, ending='.ply'):
-    """Checks that the file exists and has the right ending"""
+    """Checks that the file exists and has the right ending, which may be
+    followed by the suffix of a compressed file"""
     if not os.path.isfile(fname):
         raise FileNotFoundError('Cannot read points from a nonexistent file')
-    if not fname.endswith(ending):
+    if not (fname.endswith(ending) or _is_stream(fname) and
+            fname[:-3].endswith(ending)):
         raise ValueError('Tried to read file type {}, expected {}.'.format(
-            fname[-4:], ending))
+            fname[-4:], ending if isinstance(ending, str) else
+            ' or '.join(ending)))
+
+
+def _is_pix4d(fname: str) -> bool:
+    """Return whether fname is the first part of a Pix4D cloud, so points
+    are offset as for :py:func:`_read_pix4d_ply_parts` - even if it is
+    the only part."""
+    return stem(fname).endswith('_point_cloud_part_1')
+
+
+def pix4d_parts(fname: str) -> List[str]:
+    """Return the list of files in a Pix4D multi-part cloud, or [fname].
+    Later parts are compressed in the same way as the first, if at all."""
+    if not _is_pix4d(fname):
+        return [fname]
+    parts, p = [fname], 1
+    stub = stem(fname)[:-len('_point_cloud_part_1')]
+    suffix = fname[len(stem(fname)):]
+    while True:
+        p += 1
+        part = stub + '_point_cloud_part_{}'.format(p) + suffix
+        if not os.path.isfile(part):
+            return parts
+        parts.append(part)
 
 
 def read(fname: str) -> Iterator:
     """Passes the file to a read function for that format."""
-    if fname.endswith('_point_cloud_part_1.ply'):
-        parts, p = [fname], 1
-        stub = fname.replace('_point_cloud_part_1.ply', '')
-        while True:
-            p += 1
-            part = stub + '_point_cloud_part_{}.ply'.format(p)
-            if os.path.isfile(part):
-                parts.append(part)
-            else:
-                return _read_pix4d_ply_parts(parts)
+    if _is_pix4d(fname):
+        return _read_pix4d_ply_parts(pix4d_parts(fname))
     return _read_ply(fname)
 
 
-def _read_pix4d_ply_parts(fname_list: List[str]) -> Iterator:
+def read_chunks(fname: str, chunk_size: int=2**18) -> Iterator[np.ndarray]:
+    """Yield the points in the file as Numpy structured arrays.
+
+    Field names are those of the vertex properties, as for :py:func:`read`.
+    Each array holds at most ``chunk_size`` points, in native byte order.
+    The x, y, and z fields are always float64, so that offsets for Pix4D
+    multi-part files can be applied without loss of precision; other fields
+    keep the type declared in the header.
+    """
+    if _is_pix4d(fname):
+        return _read_pix4d_ply_parts_chunks(pix4d_parts(fname), chunk_size)
+    return _read_ply_chunks(fname, chunk_size)
+
+
+def _read_pix4d_ply_parts(fname_list: List[str],
+                          chunk_size: int=2**16) -> Iterator:
     """Yield points from a list of Pix4D ply files as if they were one file.
 
     Pix4D usually exports point clouds in parts, with an xyz offset for the
@@ -86,17 +183,83 @@ def _read_pix4d_ply_parts(fname_list: List[str]) -> Iterator:
     of precision (to any significant degree).  However UTM XY coordinates
     can't be added; we don't know the UTM zone and loss of precision may
     be noticible if we did.
+
+    Points are decoded a chunk at a time, as for
+    :py:func:`_read_pix4d_ply_parts_chunks`, then split into tuples.
+    """
+    header = read_header(fname_list[0])
+    return _points(_read_pix4d_ply_parts_chunks(fname_list, chunk_size),
+                   header.names)
+
+
+def _points(chunks: Iterator[np.ndarray], names: Tuple[str, ...]) -> Iterator:
+    """Yield a namedtuple for each point in the chunks."""
+    point = namedtuple('Point', names)  # type: ignore
+    for chunk in chunks:
+        yield from map(point._make, chunk.tolist())  # type: ignore
+
+
+def _read_pix4d_ply_parts_chunks(fname_list: List[str],
+                                 chunk_size: int) -> Iterator[np.ndarray]:
+    """Yield chunks from a list of Pix4D ply files as if they were one file.
+
+    As for :py:func:`_read_pix4d_ply_parts`, but offsets are applied to each
+    chunk with one vectorised add per coordinate.  Chunks are read on a
+    background thread, so the next chunk - or the start of the next part -
+    is read while the current chunk is processed.
+    """
+    ranges = part_ranges(fname_list[0])
+    return _prefetch(itertools.chain.from_iterable(
+        read_range(r, chunk_size) for r in ranges))
+
+
+_DONE = object()
+
+
+def _prefetch(items: Iterator, depth: int=2) -> Iterator:
+    """Yield from items, which are computed ahead on a background thread.
+
+    At most depth items are held ready, so memory use is bounded.  Any
+    exception from items is raised in the consumer, and the thread stops
+    if the consumer stops early.
     """
-    for f in fname_list:
-        _check_input(f)
-    f = fname_list.pop(0)
-    ox, oy, oz = offset_for(f)
-    for p in _read_ply(f):
-        yield p._replace(z=p.z+oz)
-    for f in fname_list:
-        dx, dy, dz = [b - a for a, b in zip([ox, oy, 0], offset_for(f))]
-        for p in _read_ply(f):
-            yield p._replace(x=p.x+dx)._replace(y=p.y+dy)._replace(z=p.z+dz)
+    ready = queue.Queue(maxsize=depth)  # type: queue.Queue
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        """Wait for space to put item in the queue, unless stopped."""
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        """Put each item in the queue, then a marker for the end."""
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as err:  # pylint:disable=broad-except
+            put((None, err))
+            return
+        put((_DONE, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err = ready.get()
+            if err is not None:
+                raise err
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 def ply_header_text(filename: str) -> bytes:
@@ -107,16 +270,36 @@ def ply_header_text(filename: str) -> bytes:
     """
     _check_input(filename)
     header = b''
-    with open(filename, 'rb') as f:
+    with _open(filename) as f:
         while b'end_header' not in header:
             header += next(f)  # type: ignore
     return header
 
 
+def read_header(fname: str) -> PlyHeader:
+    """Return the header of a .ply file, or the equivalent for the points
+    read from a .las file."""
+    if lasfile.is_las(fname):
+        return _las_ply_header(lasfile.read_las_header(fname))
+    return parse_ply_header(ply_header_text(fname))
+
+
+def _las_ply_header(header: lasfile.LasHeader) -> PlyHeader:
+    """Return the equivalent of a .ply header for the points read from a
+    .las file, as used to write them to a .ply file."""
+    names = ('x', 'y', 'z')  # type: Tuple[str, ...]
+    if lasfile.RGB_OFFSETS[header.point_format] is not None:
+        names += ('red', 'green', 'blue')
+    return PlyHeader(
+        header.count, names, '<fff' + 'BBB' * (len(names) > 3), ())
+
+
 def parse_ply_header(header_text: bytes) -> PlyHeader:
     """Parse the bytes of a .ply header to useful data about the vertices.
 
     Deliberately discards the non-vertex data - this is a pointcloud module!
+    The byte order of form_str is ``'='`` for ASCII files, which are read
+    into arrays of the native byte order.
     """
     # Get file lines, do some basic validation
     lines = [l.strip() for l in header_text.decode('ascii').split('\n')]
@@ -126,9 +309,6 @@ def parse_ply_header(header_text: bytes) -> PlyHeader:
     if not data_format.startswith('format'):
         raise ValueError(
             'Unknown data format "{}" for .ply file.'.format(data_format))
-    if 'ascii' in data_format:
-        raise ValueError('ASCII format .ply files not supported at this time.')
-
     # Extract comments from lines
     comments = tuple(c for c in lines if c.startswith('comment '))
     lines = [l for l in lines if not l.startswith('comment ')]
@@ -144,6 +324,8 @@ def parse_ply_header(header_text: bytes) -> PlyHeader:
 
     # Get Struct format from list of property types
     form_str = '>' if 'binary_big_endian' in data_format else '<'
+    if 'ascii' in data_format:
+        form_str = '='
     form_str += ''.join(PLY_TYPES[t] for t, n in properties)
 
     # Get Namedtuple instance from property names
@@ -155,18 +337,409 @@ def parse_ply_header(header_text: bytes) -> PlyHeader:
     return PlyHeader(int(vertex_count), names, form_str, comments)
 
 
-def _read_ply(fname: str) -> Iterator:
+def _read_ply(fname: str, chunk_size: int=2**16) -> Iterator:
     """Opens the specified file, and returns a point set in the format required
     by attributes_from_cloud.  Only handles xyzrgb point clouds, but that's
-    a fine subset of the format.  See http://paulbourke.net/dataformats/ply/"""
+    a fine subset of the format.  See http://paulbourke.net/dataformats/ply/
+
+    Points are decoded a chunk at a time, then split into tuples."""
+    header = read_header(fname)
+    return _points(_read_ply_chunks(fname, chunk_size), header.names)
+
+
+def vertex_dtype(header: PlyHeader) -> np.dtype:
+    """Return the Numpy structured dtype of vertex records in the file."""
+    order = header.form_str[0]
+    return np.dtype([(n, order + t) for n, t in zip(
+        header.names, header.form_str[1:])])
+
+
+def compression(header: PlyHeader) -> Tuple[str, float]:
+    """Return the codec and scale of coordinates of a compressed file, or
+    ``('', 0.0)`` for an uncompressed file."""
+    for com in header.comments:
+        if com.startswith('comment compressed '):
+            _, _, codec, _, scale = com.split(' ')
+            return codec, float(scale)
+    return '', 0.0
+
+
+def _is_ascii(header: PlyHeader) -> bool:
+    """Return whether the header is of an ASCII .ply file."""
+    return header.form_str[0] == '='
+
+
+def _stored_dtype(header: PlyHeader, scale: float) -> np.dtype:
+    """Return the dtype of vertex records as stored, with coordinates as
+    int32 multiples of scale if it is nonzero."""
+    if not scale:
+        return vertex_dtype(header)
+    return np.dtype([(n, '>i4' if n in ('x', 'y', 'z') else '>' + t)
+                     for n, t in zip(header.names, header.form_str[1:])])
+
+
+def _chunk_dtype(header: PlyHeader) -> np.dtype:
+    """Return the dtype of chunks from read_chunks for this header."""
+    return np.dtype([(n, 'f8' if n in ('x', 'y', 'z') else '=' + t)
+                     for n, t in zip(header.names, header.form_str[1:])])
+
+
+def open_mmap(fname: str) -> np.ndarray:
+    """Return a read-only memory map of the vertices in a binary .ply file.
+
+    The result is a structured array of :py:func:`vertex_dtype`, in the byte
+    order of the file, so indexing, slicing, and striding do not copy or
+    parse any data.  Repeated passes over the same file are served from the
+    OS page cache.  Only the given file is mapped - Pix4D offsets are not
+    applied, and other parts of a multi-part cloud are ignored.  Compressed
+    and ASCII files can not be mapped.
+    """
     header_bytes = ply_header_text(fname)
     header = parse_ply_header(header_bytes)
-    point = namedtuple('Point', header.names)  # type: ignore
-    fmt = struct.Struct(header.form_str)
-    with open(fname, 'rb') as f:
-        f.seek(len(header_bytes))
-        for _ in range(header.vertex_count):
-            yield point._make(fmt.unpack(f.read(fmt.size)))  # type: ignore
+    if compression(header)[0] or _is_stream(fname):
+        raise ValueError('Can not map a compressed file, ' + fname)
+    if _is_ascii(header):
+        raise ValueError('Can not map an ASCII file, ' + fname)
+    dtype = vertex_dtype(header)
+    if header.vertex_count == 0:
+        return np.memmap(fname, dtype=dtype, mode='r', shape=(0,))[:0]
+    return np.memmap(fname, dtype=dtype, mode='r', offset=len(header_bytes),
+                     shape=(header.vertex_count,))
+
+
+def _read_ply_chunks(fname: str, chunk_size: int) -> Iterator[np.ndarray]:
+    """Yield structured arrays of vertices from a binary .ply file."""
+    count = read_header(fname).vertex_count
+    return read_range(VertexRange(fname, 0, count, (0, 0, 0)), chunk_size)
+
+
+def part_ranges(fname: str) -> List[VertexRange]:
+    """Return a range covering all the vertices of each part of the cloud.
+
+    This is a single range unless fname is the first of a Pix4D multi-part
+    cloud.  For the first part of a Pix4D cloud, even with no other parts,
+    each range carries the offset to apply to that part as for
+    :py:func:`read_chunks`.
+    """
+    parts = pix4d_parts(fname)
+    for f in parts:
+        _check_input(f, ('.ply', '.las'))
+    ox, oy, _ = offset_for(parts[0])
+    ranges = []  # type: List[VertexRange]
+    for f in parts:
+        offset = (0, 0, 0)  # type: Tuple[float, float, float]
+        if _is_pix4d(fname):
+            dx, dy, dz = [b - a for a, b in zip([ox, oy, 0], offset_for(f))]
+            offset = (dx, dy, dz)
+        size = read_header(f).vertex_count
+        ranges.append(VertexRange(f, 0, size, offset))
+    return ranges
+
+
+def vertex_ranges(fname: str, count: int) -> List[VertexRange]:
+    """Split the vertices in a file into about count ranges of equal size.
+
+    Vertex records have a fixed size, so each range can be read from a
+    known position in the file independently of the others.  Ranges do not
+    span parts of a Pix4D multi-part cloud, and carry the offset to apply
+    to each part as for :py:func:`read_chunks`.  Compressed files (eg.
+    ``.ply.gz``) and ASCII files can only be read from the start, so are
+    not split.
+    """
+    parts = part_ranges(fname)
+    step = max(1, -(-sum(p.stop for p in parts) // max(count, 1)))
+    ranges = []  # type: List[VertexRange]
+    for part in parts:
+        size = step
+        if _is_stream(part.fname) or _is_ascii(read_header(part.fname)):
+            size = max(1, part.stop)
+        ranges.extend(part._replace(start=start, stop=min(start + size,
+                                                           part.stop))
+                      for start in range(0, part.stop, size))
+    return ranges
+
+
+class ReadAhead:
+    """Settings for reading vertices ahead of their use.
+
+    Every read of vertices fills buffers of about ``buffer_size`` bytes on a
+    background thread, while the previous buffer is decoded and processed,
+    so that disk (or network filesystem) and CPU are busy at the same time.
+    ``depth`` is the number of buffers: 2 for double buffering, 3 to allow
+    for more variable latency, or 1 to read without a thread.  Buffers are
+    aligned to ``alignment`` bytes.  Set these before reading, eg. from the
+    ``--readbuffer`` and ``--readdepth`` options of :py:mod:`~src.forestutils`.
+    """
+    # pylint:disable=too-few-public-methods
+    buffer_size = 2**23
+    depth = 3
+    alignment = 4096
+
+
+def _aligned_buffer(size: int) -> np.ndarray:
+    """Return an uninitialised byte array of size, aligned in memory."""
+    raw = np.empty(size + ReadAhead.alignment, dtype=np.uint8)
+    start = -raw.ctypes.data % ReadAhead.alignment
+    return raw[start:start + size]
+
+
+def _fill(f, buf: np.ndarray) -> int:
+    """Read from f into buf until it is full or the file ends, and return
+    the number of bytes read."""
+    got = 0
+    while got < buf.size:
+        n = f.readinto(buf[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def _read_ahead(fname: str, start: int, stop: int,
+                block: int) -> Iterator[np.ndarray]:
+    """Yield the bytes of fname from start to stop, in blocks of up to block
+    bytes, which are read ahead on a background thread.  A short block is
+    the end of the file.
+
+    Each block is a view of a reused buffer, so is only valid until the
+    next block is requested.
+    """
+    with _open(fname, raw=True) as f:
+        f.seek(start)
+        if ReadAhead.depth < 2 or stop - start <= block:
+            buf = _aligned_buffer(min(block, stop - start))
+            for pos in range(start, stop, block):
+                size = min(block, stop - pos)
+                got = _fill(f, buf[:size])
+                yield buf[:got]
+                if got < size:
+                    return
+            return
+        free = queue.Queue()  # type: queue.Queue
+        ready = queue.Queue()  # type: queue.Queue
+        for _ in range(ReadAhead.depth):
+            free.put(_aligned_buffer(block))
+
+        def produce() -> None:
+            """Fill free buffers in order, and pass them to the consumer,
+            followed by any error and then a marker for the end."""
+            try:
+                for pos in range(start, stop, block):
+                    buf = free.get()
+                    if buf is None:
+                        return
+                    size = min(block, stop - pos)
+                    got = _fill(f, buf[:size])
+                    ready.put((buf, got, None))
+                    if got < size:
+                        break
+            except Exception as err:  # pylint:disable=broad-except
+                ready.put((None, 0, err))
+            finally:
+                ready.put((None, 0, None))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                buf, size, err = ready.get()
+                if err is not None:
+                    raise err
+                if buf is None:
+                    return
+                yield buf[:size]
+                free.put(buf)
+        finally:
+            free.put(None)
+            thread.join()
+
+
+def read_range(vertices: VertexRange,
+               chunk_size: int=2**18) -> Iterator[np.ndarray]:
+    """Yield chunks of the given range of vertices, as for read_chunks.
+
+    Vertices are read ahead in buffers of whole chunks, as configured by
+    :py:class:`ReadAhead`.  Only the blocks of a compressed file which
+    overlap the range are decompressed."""
+    if lasfile.is_las(vertices.fname):
+        las = lasfile.read_las_header(vertices.fname)
+        out_dtype = _chunk_dtype(_las_ply_header(las))
+        chunks = (lasfile.decode(rec, las, vertices.fname, out_dtype)
+                  for rec in _binary_records(
+                      vertices, las.point_offset, lasfile.record_dtype(las),
+                      chunk_size))  # type: Iterator[np.ndarray]
+    else:
+        chunks = _ply_range(vertices, chunk_size)
+    for chunk in chunks:
+        if any(vertices.offset):
+            chunk['x'] += vertices.offset[0]
+            chunk['y'] += vertices.offset[1]
+            chunk['z'] += vertices.offset[2]
+        yield chunk
+
+
+def _ply_range(vertices: VertexRange,
+               chunk_size: int) -> Iterator[np.ndarray]:
+    """Yield chunks of the range of vertices in a .ply file, without any
+    offset for Pix4D parts."""
+    header_bytes = ply_header_text(vertices.fname)
+    header = parse_ply_header(header_bytes)
+    codec, scale = compression(header)
+    dtype, out_dtype = _stored_dtype(header, scale), _chunk_dtype(header)
+    if codec:
+        blocks = _compressed_blocks(vertices, len(header_bytes), dtype, codec)
+        if ReadAhead.depth >= 2:
+            blocks = _prefetch(blocks, ReadAhead.depth - 1)
+        records = _rechunk(blocks, chunk_size)
+    elif _is_ascii(header):
+        records = _rechunk(
+            _ascii_records(vertices, len(header_bytes), dtype), chunk_size)
+    else:
+        records = _binary_records(vertices, len(header_bytes), dtype,
+                                  chunk_size)
+    for rec in records:
+        chunk = rec.astype(out_dtype)
+        if scale:
+            chunk['x'] *= scale
+            chunk['y'] *= scale
+            chunk['z'] *= scale
+        yield chunk
+
+
+def _binary_records(vertices: VertexRange, offset: int, dtype: np.dtype,
+                    chunk_size: int) -> Iterator[np.ndarray]:
+    """Yield chunks of records in the range of an uncompressed file, whose
+    vertices start at offset.  Each is only valid until the next."""
+    per_block = chunk_size * max(
+        1, ReadAhead.buffer_size // (chunk_size * dtype.itemsize))
+    blocks = _read_ahead(
+        vertices.fname, offset + vertices.start * dtype.itemsize,
+        offset + vertices.stop * dtype.itemsize, per_block * dtype.itemsize)
+    for start, block in zip(range(vertices.start, vertices.stop, per_block),
+                            blocks):
+        if block.size != min(per_block, vertices.stop - start) * dtype.itemsize:
+            raise ValueError('Unexpected end of file ' + vertices.fname)
+        records = np.frombuffer(block, dtype=dtype)
+        for n in range(0, records.size, chunk_size):
+            yield records[n:n + chunk_size]
+
+
+def _ascii_records(vertices: VertexRange, offset: int,
+                   dtype: np.dtype) -> Iterator[np.ndarray]:
+    """Yield the records in the range of an ASCII file, whose vertices start
+    at offset, a buffer at a time.
+
+    Each buffer of text is cut after the last complete line, and parsed by
+    Numpy in one call.  Values are cast to the types in the header, so
+    points are the same as from a binary file.
+    """
+    end = os.path.getsize(vertices.fname)
+    if _is_stream(vertices.fname):
+        # The uncompressed size is unknown, so read until enough lines
+        end = 2**63 - 1
+    line, rest = 0, b''
+    blocks = _read_ahead(vertices.fname, offset, end, ReadAhead.buffer_size)
+    # A final newline ends the last line, if the file does not
+    for block in itertools.chain(blocks, [np.frombuffer(b'\n', np.uint8)]):
+        if line >= vertices.stop:
+            break
+        text = rest + block.tobytes()
+        ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10)
+        first = min(max(vertices.start - line, 0), ends.size)
+        last = min(vertices.stop - line, ends.size)
+        if first < last:
+            start = int(ends[first - 1]) + 1 if first else 0
+            yield _parse_ascii(text[start:int(ends[last - 1]) + 1], dtype,
+                               last - first, vertices.fname)
+        line += ends.size
+        rest = text[int(ends[-1]) + 1:] if ends.size else text
+    if line < vertices.stop:
+        raise ValueError('Unexpected end of file ' + vertices.fname)
+
+
+def _parse_ascii(text: bytes, dtype: np.dtype, lines: int,
+                 fname: str) -> np.ndarray:
+    """Return the records in lines of text, each a vertex of dtype."""
+    names = dtype.names or ()
+    values = np.fromstring(text, sep=' ')
+    if values.size != lines * len(names):
+        raise ValueError('Expected {} values on each line of {}'.format(
+            len(names), fname))
+    values = values.reshape(lines, len(names))
+    records = np.empty(lines, dtype)
+    for n, name in enumerate(names):
+        records[name] = values[:, n]
+    return records
+
+
+def _compressed_blocks(vertices: VertexRange, offset: int, dtype: np.dtype,
+                       codec: str) -> Iterator[np.ndarray]:
+    """Yield the records in the range of a compressed file, whose blocks
+    start at offset, a decompressed block at a time.  Blocks before the
+    range are skipped without decompressing them."""
+    decompress = CODECS[codec][1]
+    with _open(vertices.fname) as f:
+        f.seek(offset)
+        pos = 0
+        while pos < vertices.stop:
+            head = f.read(BLOCK_HEAD.size)
+            if len(head) < BLOCK_HEAD.size:
+                raise ValueError('Unexpected end of file ' + vertices.fname)
+            count, nbytes = BLOCK_HEAD.unpack(head)
+            if pos + count <= vertices.start:
+                f.seek(nbytes, os.SEEK_CUR)
+            else:
+                planes = np.frombuffer(decompress(f.read(nbytes)), np.uint8)
+                records = planes.reshape(dtype.itemsize, count).T.copy().view(
+                    dtype).reshape(count)
+                yield records[max(vertices.start - pos, 0):
+                              vertices.stop - pos]
+            pos += count
+
+
+def _rechunk(arrays: Iterator[np.ndarray],
+             size: int) -> Iterator[np.ndarray]:
+    """Yield the records in arrays of any size as chunks of size records,
+    except for the last."""
+    pending, count = [], 0
+    for arr in arrays:
+        pending.append(arr)
+        count += arr.size
+        if count < size:
+            continue
+        # Join once per full chunk, rather than once per array
+        joined = np.concatenate(pending)
+        whole = count - count % size
+        for start in range(0, whole, size):
+            yield joined[start:start + size]
+        pending, count = [joined[whole:]], count - whole
+    if count:
+        yield np.concatenate(pending)
+
+
+def _reduce_range(func: Callable, vertices: VertexRange, chunk_size: int):
+    """Call func with an iterator of chunks from the range of vertices."""
+    return func(read_range(vertices, chunk_size))
+
+
+def map_ranges(func: Callable, fname: str, executor: Executor, count: int,
+               chunk_size: int=2**18) -> Iterator:
+    """Apply func to each of about count ranges of vertices in the file, in
+    parallel, and yield the results in the order they complete.  Results
+    are not kept once yielded, so the caller can combine and drop each.
+
+    func is called with an iterator of chunks (as from :py:func:`read_chunks`)
+    for one range, and usually returns an aggregate of those points.  With
+    a ``ProcessPoolExecutor`` func must be picklable, ie. defined at the top
+    level of a module; with a ``ThreadPoolExecutor`` decoding still runs in
+    parallel as Numpy releases the GIL for large copies.
+    """
+    pending = {executor.submit(_reduce_range, func, vertices, chunk_size)
+               for vertices in vertex_ranges(fname, count)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        while done:
+            yield done.pop().result()
 
 
 class IncrementalWriter:
@@ -177,11 +750,18 @@ class IncrementalWriter:
     streaming points to disk even when the header is unknown in advance.
     This allows some nice tricks, including splitting a point cloud into
     multiple files in a single pass, without memory issues.
+
+    With a codec, x, y, and z are stored as int32 multiples of scale from
+    the UTM origin of the file, and blocks of points are compressed as
+    they are added.  The header lists the types of points when read, with
+    a comment giving the codec and scale.  Other programs can not read
+    such files, so this is only worthwhile for large archives.
     """
-    # pylint:disable=too-few-public-methods
+    # pylint:disable=too-few-public-methods,too-many-instance-attributes
 
     def __init__(self, filename: str, header: PlyHeader,
-                 utm: UTM_Coord=None, buffer=2**22) -> None:
+                 utm: UTM_Coord=None, buffer=2**22, *, codec: str='',
+                 scale: float=0.001, block: int=2**16) -> None:
         """
         Args:
             filename: final place to save the file on disk.
@@ -191,14 +771,32 @@ class IncrementalWriter:
                 the temporary file to disk.  Default 1MB, which holds ~8300
                 points - enough for most objects but still practical to hold
                 thousands in memory.  Set a smaller buffer for large forests.
+            codec (str): a key of :py:data:`CODECS` to compress the file,
+                or '' (the default) for an uncompressed file.
+            scale (float): the precision of stored coordinates, if
+                compressed.  Default 0.001, ie. millimetres.
+            block (int): the minimum number of points to compress at once.
         """
+        # pylint:disable=too-many-arguments
+        if codec and codec not in CODECS:
+            raise ValueError('Unknown codec {}, expected one of {}'.format(
+                codec, sorted(CODECS)))
         self.filename = filename
         self.temp_storage = SpooledTemporaryFile(max_size=buffer, mode='w+b')
         self.count = 0
         self.utm = utm
         self.header = header
+        self.codec = codec
+        self.scale = scale if codec else 0.0
+        self.block = block
+        self.pending = []  # type: List[np.ndarray]
+        self.pending_count = 0
+        # Points added one at a time, to convert a block at once
+        self.buffered = []  # type: List[Point]
         # Always write in big-endian mode; only store type information
         self.binary = struct.Struct('>' + header.form_str[1:])
+        self.dtype = vertex_dtype(header).newbyteorder('>')
+        self.stored = _stored_dtype(header, self.scale).newbyteorder('>')
 
     def __call__(self, point) -> None:
         """Add a single point to this pointcloud, saving in binary format.
@@ -206,27 +804,79 @@ class IncrementalWriter:
         Args:
             point (namedtuple): vertex attributes for the point, eg xyzrgba.
         """
+        if self.codec:
+            self.buffered.append(point)
+            if len(self.buffered) >= self.block:
+                self._flush_buffered()
+            return
         self.temp_storage.write(self.binary.pack(*point))
         self.count += 1
 
-    def __del__(self):
-        """Flush data to disk and clean up."""
-        to_ply_types = {v: k for k, v in PLY_TYPES.items()}
-        properties = ['property {t} {n}'.format(t=t, n=n) for t, n in zip(
-            (to_ply_types[p] for p in self.header.form_str[1:]),
-            self.header.names)]
-        head = ['ply',
-                'format binary_big_endian 1.0',
-                'element vertex {}'.format(self.count),
-                '\n'.join(properties),
-                'end_header']
-        if self.utm is not None:
-            head.insert(-1, 'comment UTM x y zone north ' +
-                        '{0.x} {0.y} {0.zone} {0.north}'.format(self.utm))
-        if not os.path.isdir(os.path.dirname(self.filename)):
-            os.makedirs(os.path.dirname(self.filename))
-        with open(self.filename, 'wb') as f:
-            f.write(('\n'.join(head) + '\n').encode('ascii'))
+    def extend(self, points) -> None:
+        """Add many points to this pointcloud, with a single write.
+
+        Args:
+            points: a Numpy structured array with a field for each vertex
+                attribute (eg. a chunk from :py:func:`read_chunks`), or a
+                sequence of tuples of vertex attributes.  Values are cast to
+                the types in the header, and swapped to big-endian order.
+        """
+        self._flush_buffered()
+        if not (isinstance(points, np.ndarray) and points.dtype.names):
+            points = np.array(list(points), dtype=self.dtype)
+        data = np.empty(points.shape, self.stored)
+        for name in self.header.names:
+            if self.scale and name in ('x', 'y', 'z'):
+                data[name] = self._quantize(points[name])
+            else:
+                data[name] = points[name]
+        self.count += data.size
+        if not self.codec:
+            self.temp_storage.write(data.tobytes())
+            return
+        self.pending.append(data)
+        self.pending_count += data.size
+        if self.pending_count >= self.block:
+            self._compress()
+
+    def _flush_buffered(self) -> None:
+        """Add the points buffered by single calls, in order."""
+        points, self.buffered = self.buffered, []
+        if points:
+            self.extend(points)
+
+    def _quantize(self, values: np.ndarray) -> np.ndarray:
+        """Return coordinates as the nearest int32 multiples of scale."""
+        steps = np.round(np.asarray(values, dtype=np.float64) / self.scale)
+        if steps.size and np.abs(steps).max() > np.iinfo(np.int32).max:
+            raise ValueError('Coordinates too large to store at scale {} '
+                             'in {}'.format(self.scale, self.filename))
+        return steps.astype(np.int32)
+
+    def _compress(self) -> None:
+        """Compress the pending points as one block."""
+        self._flush_buffered()
+        if not self.pending:
+            return
+        data = np.frombuffer(b''.join(p.tobytes() for p in self.pending),
+                             dtype=np.uint8)
+        payload = CODECS[self.codec][0](
+            data.reshape(-1, self.stored.itemsize).T.tobytes())
+        self.temp_storage.write(BLOCK_HEAD.pack(
+            self.pending_count, len(payload)))
+        self.temp_storage.write(payload)
+        self.pending, self.pending_count = [], 0
+
+    def close(self) -> None:
+        """Write the file to disk, and clean up.  Further points can not be
+        added.  This is called when the writer is garbage-collected, but
+        calling it explicitly ensures the file is complete."""
+        if self.temp_storage.closed:
+            return
+        self._compress()
+        with _create(self.filename) as f:
+            f.write(ply_header_bytes(self.header, self.count, self.utm,
+                                     self.codec, self.scale))
             self.temp_storage.seek(0)
             chunk = self.temp_storage.read(8192)
             while chunk:
@@ -234,10 +884,187 @@ class IncrementalWriter:
                 chunk = self.temp_storage.read(8192)
         self.temp_storage.close()
 
+    def __del__(self):
+        """Flush data to disk and clean up."""
+        # __init__ raises before creating the file if the codec is unknown
+        if hasattr(self, 'temp_storage'):
+            self.close()
+
+
+def ply_header_bytes(header: PlyHeader, count: int,
+                     utm: Optional[UTM_Coord]=None, codec: str='',
+                     scale: float=0.0) -> bytes:
+    """Return the header of a big-endian binary .ply file of count vertices,
+    as written by :py:class:`IncrementalWriter`, which may be compressed
+    with codec at scale."""
+    to_ply_types = {v: k for k, v in PLY_TYPES.items()}
+    properties = ['property {t} {n}'.format(t=t, n=n) for t, n in zip(
+        (to_ply_types[p] for p in header.form_str[1:]), header.names)]
+    head = ['ply',
+            'format binary_big_endian 1.0',
+            'element vertex {}'.format(count),
+            '\n'.join(properties),
+            'end_header']
+    if utm is not None:
+        head.insert(-1, 'comment UTM x y zone north ' +
+                    '{0.x} {0.y} {0.zone} {0.north}'.format(utm))
+    if codec:
+        head.insert(-1, 'comment compressed {} scale {}'.format(codec, scale))
+    return ('\n'.join(head) + '\n').encode('ascii')
+
+
+def _create(fname: str):
+    """Open fname for writing in binary mode, creating the directory."""
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return open(fname, 'wb')
+
+
+class PartitionWriter:
+    """Split points into many files by an integer label for each point,
+    using bounded memory and a bounded number of open files.
+
+    Points are spilled to ``max_open`` temporary bucket files by label, and
+    when closed each bucket is sorted by label and each labelled file is
+    written in full - so at most ``max_open + 1`` files are open at once,
+    regardless of the number of labels.  Points are buffered in memory up
+    to ``memory`` bytes before spilling, and buckets larger than that are
+    split into several passes.  The order of points with the same label is
+    kept, and the files are the same as from an :py:class:`IncrementalWriter`
+    for each label.
+    """
+    # pylint:disable=too-many-instance-attributes
+
+    def __init__(self, fname_for: Callable[[int], str], header: PlyHeader,
+                 utm: Optional[UTM_Coord]=None, *, memory: int=2**26,
+                 max_open: int=64) -> None:
+        """
+        Args:
+            fname_for: called with a label, to get the name of the file
+                for points with that label.
+            memory (int): approximate maximum bytes of points to hold in
+                memory at once.
+            max_open (int): the number of temporary bucket files.
+        """
+        self.fname_for = fname_for
+        self.header = header
+        self.utm = utm
+        self.memory = memory
+        point = vertex_dtype(header).newbyteorder('>')
+        self.dtype = np.dtype([('label', '<i8'), ('point', point)])
+        self.buckets = [TemporaryFile() for _ in range(max_open)]
+        self.buffers = [[] for _ in self.buckets]  # type: List[list]
+        self.buffered = 0
+        self.counts = {}  # type: Dict[int, int]
+
+    def __enter__(self) -> 'PartitionWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write(self, labels: np.ndarray, points: np.ndarray) -> None:
+        """Add points (a structured array, as from :py:func:`read_chunks`)
+        to the file for the label of each point."""
+        if not points.size:
+            return
+        records = np.empty(points.shape, self.dtype)
+        records['label'] = labels
+        for name in self.header.names:
+            records['point'][name] = points[name]
+        order = np.argsort(records['label'] % len(self.buckets), kind='stable')
+        records = records[order]
+        bucket = records['label'] % len(self.buckets)
+        starts = np.flatnonzero(
+            np.concatenate([[True], bucket[1:] != bucket[:-1]]))
+        for start, stop in zip(starts.tolist(), starts[1:].tolist() + [None]):
+            self.buffers[int(bucket[start])].append(records[start:stop])
+        labels, counts = np.unique(records['label'], return_counts=True)
+        for label, count in zip(labels.tolist(), counts.tolist()):
+            self.counts[label] = self.counts.get(label, 0) + count
+        self.buffered += records.nbytes
+        if self.buffered > self.memory:
+            self._spill()
+
+    def _spill(self) -> None:
+        """Write all buffered points to their bucket files."""
+        for bucket, buffer in zip(self.buckets, self.buffers):
+            if buffer:
+                bucket.write(b''.join(r.tobytes() for r in buffer))
+                buffer.clear()
+        self.buffered = 0
+
+    def close(self) -> None:
+        """Write every labelled file, and clean up."""
+        if not self.buckets:
+            return
+        self._spill()
+        for index, bucket in enumerate(self.buckets):
+            labels = sorted(l for l in self.counts
+                            if l % len(self.buckets) == index)
+            # Group labels into passes which fit in memory
+            passes, size = [[]], 0  # type: List[List[int]], int
+            for label in labels:
+                nbytes = self.counts[label] * self.dtype.itemsize
+                if passes[-1] and size + nbytes > self.memory:
+                    passes.append([])
+                    size = 0
+                passes[-1].append(label)
+                size += nbytes
+            for group in passes:
+                if group:
+                    self._write_labels(bucket, group)
+            bucket.close()
+        self.buckets = []
+
+    def _bucket_chunks(self, bucket) -> Iterator[np.ndarray]:
+        """Yield chunks of records from a bucket file."""
+        bucket.seek(0)
+        size = max(1, self.memory // self.dtype.itemsize) * self.dtype.itemsize
+        buf = bucket.read(size)
+        while buf:
+            yield np.frombuffer(buf, dtype=self.dtype)
+            buf = bucket.read(size)
+
+    def _write_labels(self, bucket, labels: List[int]) -> None:
+        """Write the files for the given labels from records in bucket."""
+        if len(labels) == 1:
+            # Stream the records, which may not fit in memory
+            with _create(self.fname_for(labels[0])) as f:
+                f.write(ply_header_bytes(
+                    self.header, self.counts[labels[0]], self.utm))
+                for chunk in self._bucket_chunks(bucket):
+                    f.write(chunk['point'][chunk['label'] == labels[0]]
+                            .tobytes())
+            return
+        # Numpy may concatenate to native byte order, so cast back
+        records = np.concatenate([
+            chunk[np.isin(chunk['label'], labels)]
+            for chunk in self._bucket_chunks(bucket)]).astype(self.dtype)
+        records = records[np.argsort(records['label'], kind='stable')]
+        starts = np.searchsorted(records['label'], labels)
+        for label, start in zip(labels, starts.tolist()):
+            with _create(self.fname_for(label)) as f:
+                f.write(ply_header_bytes(
+                    self.header, self.counts[label], self.utm))
+                f.write(records['point'][
+                    start:start + self.counts[label]].tobytes())
+
 
 def write(cloud: Iterator, fname: str, header: PlyHeader,
-          utm: UTM_Coord) -> None:
-    """Write the given cloud to disk."""
-    writer = IncrementalWriter(fname, header, utm)
+          utm: UTM_Coord, codec: str='', scale: float=0.001) -> None:
+    """Write the given cloud to disk.
+
+    The cloud may yield single points, or chunks of points as structured
+    arrays - which are much faster to write.  The file is compressed if a
+    codec is given, as for :py:class:`IncrementalWriter`.
+    """
+    # pylint:disable=too-many-arguments
+    writer = IncrementalWriter(fname, header, utm, codec=codec, scale=scale)
     for p in cloud:
-        writer(p)
+        if isinstance(p, np.ndarray):
+            writer.extend(p)
+        else:
+            writer(p)
+    writer.close()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Per-stage timing and resource use of the analysis.
+
+Code in :py:mod:`~src.forestutils` marks each stage of work with
+:py:func:`stage`, which does nothing unless a :py:class:`Profile` is active.
+To record stages from library code::
+
+    with profiling.Profile() as prof:
+        attr_map = forestutils.MapObj(fname)
+    prof.save('profile.json')
+
+The ``--profile`` option of the command-line tool does the same, saving the
+report next to the ``_analysis.csv`` file.
+"""
+
+import contextlib
+import json
+import sys
+import time
+from typing import List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows, where peak memory is not reported
+    resource = None  # type: ignore
+
+_ACTIVE = []  # type: List[Profile]
+
+
+def peak_rss(children: bool=False) -> int:
+    """Return the peak resident memory of this process (or the largest of
+    its finished child processes), in bytes, or zero if unknown."""
+    if resource is None:
+        return 0
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def cpu_time() -> float:
+    """Return the CPU time used by this process and its finished children."""
+    if resource is None:
+        return time.process_time()
+    return sum(getattr(resource.getrusage(who), attr)
+               for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+               for attr in ('ru_utime', 'ru_stime'))
+
+
+def io_bytes() -> Optional[Tuple[int, int]]:
+    """Return the bytes read and written by all threads of this process, or
+    None if unknown.
+
+    These are the bytes passed through read and write system calls, as
+    reported by Linux in ``/proc/self/io``, whether or not they were served
+    from the OS page cache.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _io_delta(start: Optional[Tuple[int, int]]) -> Tuple[Optional[int],
+                                                          Optional[int]]:
+    """Return the bytes read and written since start, or None if unknown."""
+    end = io_bytes()
+    if start is None or end is None:
+        return None, None
+    return end[0] - start[0], end[1] - start[1]
+
+
+class Profile:
+    """Records wall time, CPU time, points processed and throughput, bytes
+    read and written, and peak memory for each stage of work done while
+    it is active.
+
+    CPU time includes worker processes, once they have exited, but bytes
+    read and written do not, and are only measured on Linux.  Peak memory
+    is for the whole process so far - Python does not release memory to the
+    operating system promptly enough to measure stages in isolation.
+    """
+
+    def __init__(self) -> None:
+        self.stages = []  # type: List[dict]
+        self.start = time.perf_counter(), cpu_time()
+        self.start_io = io_bytes()
+
+    def __enter__(self) -> 'Profile':
+        _ACTIVE.append(self)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _ACTIVE.remove(self)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, points: int=0):
+        """Record a stage of work, named name, over the body of a with block.
+
+        This yields a dict of the measurements, to which the caller may add
+        or update ``points`` (the number of points processed) if not known
+        in advance.
+        """
+        record = {'stage': name, 'points': points}  # type: dict
+        wall, cpu, start_io = time.perf_counter(), cpu_time(), io_bytes()
+        yield record
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = cpu_time() - cpu
+        record['points_per_second'] = (record['points'] / record['wall_seconds']
+                                       if record['wall_seconds'] else None)
+        record['bytes_read'], record['bytes_written'] = _io_delta(start_io)
+        record['peak_rss_bytes'] = peak_rss()
+        record['peak_rss_children_bytes'] = peak_rss(children=True)
+        self.stages.append(record)
+
+    def report(self) -> dict:
+        """Return all the measurements as a JSON-serialisable dict."""
+        read, written = _io_delta(self.start_io)
+        return {
+            'stages': self.stages,
+            'total': {
+                'wall_seconds': time.perf_counter() - self.start[0],
+                'cpu_seconds': cpu_time() - self.start[1],
+                'bytes_read': read,
+                'bytes_written': written,
+                'peak_rss_bytes': peak_rss(),
+                'peak_rss_children_bytes': peak_rss(children=True),
+                },
+            }
+
+    def save(self, fname: str, **extra) -> None:
+        """Save the report as JSON, with any extra keys given."""
+        report = self.report()
+        report.update(extra)
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+@contextlib.contextmanager
+def stage(name: str, points: int=0):
+    """Record a stage in the active :py:class:`Profile`, as for
+    :py:meth:`Profile.stage`.  If no profile is active, the measurements
+    are discarded."""
+    if not _ACTIVE:
+        yield {'points': points}
+        return
+    with _ACTIVE[-1].stage(name, points) as record:
+        yield record
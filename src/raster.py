@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""A compact, array-backed map of per-cell attributes for point clouds.
+
+Each attribute of the map is a dense Numpy array (a "layer") over the
+bounding box of the cells seen so far, with integer offsets locating the
+array within the grid of all cells.  This costs a few bytes per cell and
+attribute, instead of the several hundred for a dict keyed by tuples, and
+allows whole chunks of points to be reduced into the map at once.
+"""
+# pylint:disable=unsubscriptable-object,invalid-sequence-index
+
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+class Raster:
+    """Named layers of per-cell values over a rectangle of grid cells.
+
+    Cells are addressed by absolute integer coordinates - the floor of each
+    spatial coordinate divided by the cell size.  ``origin`` is the
+    coordinate of the cell stored at index ``[0, 0]`` of each layer, and
+    layers are indexed ``[x - origin[0], y - origin[1]]``.  The extent grows
+    as needed to cover new cells, keeping existing data.
+    """
+
+    def __init__(self, origin: Tuple[int, int]=(0, 0),
+                 shape: Tuple[int, int]=(0, 0)) -> None:
+        self.origin = origin
+        self.shape = shape
+        self.layers = {}  # type: Dict[str, np.ndarray]
+        self.fills = {}  # type: Dict[str, object]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.layers[name]
+
+    def __setitem__(self, name: str, value: np.ndarray) -> None:
+        if value.shape != self.shape:
+            raise ValueError('Layer shape {} does not match raster {}'.format(
+                value.shape, self.shape))
+        if name not in self.fills:
+            self.fills[name] = np.zeros(1, value.dtype)[0]
+        self.layers[name] = np.ascontiguousarray(value)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.layers
+
+    def add_layer(self, name: str, dtype, fill=0) -> None:
+        """Add a layer of the given type, where every cell has value fill."""
+        self.fills[name] = fill
+        self.layers[name] = np.full(self.shape, fill, dtype=dtype)
+
+    def index(self, x, y) -> Tuple[np.ndarray, np.ndarray]:
+        """Return array indices for the cells with absolute coords x, y."""
+        return x - self.origin[0], y - self.origin[1]
+
+    def coords(self, i, j) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the absolute coords of the cells at array indices i, j."""
+        return i + self.origin[0], j + self.origin[1]
+
+    def contains(self, x, y) -> np.ndarray:
+        """Return whether each cell x, y is within the extent of the raster."""
+        i, j = self.index(x, y)
+        return (i >= 0) & (i < self.shape[0]) & (j >= 0) & (j < self.shape[1])
+
+    def get(self, name: str, x, y) -> np.ndarray:
+        """Return the value of the layer for each cell x, y, or the fill
+        value of the layer for cells outside the extent of the raster."""
+        inside = self.contains(x, y)
+        i, j = self.index(x, y)
+        out = np.full(np.shape(x), self.fills[name], self.layers[name].dtype)
+        out[inside] = self.layers[name][i[inside], j[inside]]
+        return out
+
+    def resize(self, origin: Tuple[int, int], shape: Tuple[int, int]) -> None:
+        """Change the extent of the raster, keeping data in the overlap."""
+        # The overlap of the old and new extents, in absolute coordinates
+        lo = np.maximum(origin, self.origin)
+        hi = np.minimum(np.add(origin, shape), np.add(self.origin, self.shape))
+        dst = tuple(slice(a - o, b - o) for a, b, o in zip(lo, hi, origin))
+        src = tuple(slice(a - o, b - o) for a, b, o in zip(lo, hi, self.origin))
+        for name, layer in self.layers.items():
+            new = np.full(shape, self.fills[name], dtype=layer.dtype)
+            if (hi > lo).all():
+                new[dst] = layer[src]
+            self.layers[name] = new
+        self.origin = (int(origin[0]), int(origin[1]))
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    def crop(self, origin: Tuple[int, int], shape: Tuple[int, int],
+             names=None) -> 'Raster':
+        """Return a new raster over the given extent, with copies of the
+        named layers (default all layers)."""
+        out = Raster(self.origin, self.shape)
+        for name in names or self.layers:
+            out.layers[name] = self.layers[name]
+            out.fills[name] = self.fills[name]
+        out.resize(origin, shape)
+        return out
+
+    def cover(self, x: np.ndarray, y: np.ndarray) -> None:
+        """Grow the raster to cover all the cells x, y, with a margin of at
+        least one empty cell, and space to grow without frequent copies."""
+        if not np.size(x):
+            return
+        lo = np.array([np.min(x), np.min(y)]) - 1
+        hi = np.array([np.max(x), np.max(y)]) + 2
+        start = np.array(self.origin)
+        stop = start + self.shape
+        if not any(self.shape):
+            self.resize(tuple(lo), tuple(hi - lo))
+            return
+        if (lo >= start).all() and (hi <= stop).all():
+            return
+        pad = np.maximum(np.array(self.shape) // 4, 16)
+        start = np.where(lo < start, lo - pad, start)
+        stop = np.where(hi > stop, hi + pad, stop)
+        self.resize(tuple(start), tuple(stop - start))
+
+    def trim(self, mask: np.ndarray, margin: int=1) -> None:
+        """Shrink the raster to the bounding box of cells where mask is true,
+        plus a margin of cells on each side."""
+        i, j = np.nonzero(mask)
+        if not i.size:
+            self.resize(self.origin, (0, 0))
+            return
+        x, y = self.coords(i, j)
+        origin = (x.min() - margin, y.min() - margin)
+        self.resize(origin, (x.max() + margin + 1 - origin[0],
+                             y.max() + margin + 1 - origin[1]))
+
+    def combine(self, other: 'Raster', **ufuncs) -> None:
+        """Combine the layers of another raster into this one, growing to
+        cover it.  Each keyword argument is the name of a layer, and a
+        binary ufunc (eg ``np.add``) to combine values of that layer."""
+        if not all(other.shape):
+            return
+        x, y = other.coords(np.array([0, other.shape[0] - 1]),
+                            np.array([0, other.shape[1] - 1]))
+        self.cover(x, y)
+        i, j = self.index(*other.origin)
+        cells = (slice(i, i + other.shape[0]), slice(j, j + other.shape[1]))
+        for name, ufunc in ufuncs.items():
+            self.layers[name][cells] = ufunc(
+                self.layers[name][cells], other.layers[name])
+
+    def save(self, file, names=None, **extra) -> None:
+        """Save the named layers (default all layers) to a ``.npz`` file or
+        file object, with any extra arrays given as keyword arguments."""
+        arrays = dict(extra)
+        for name in names or self.layers:
+            arrays['layer_' + name] = self.layers[name]
+            arrays['fill_' + name] = np.array(self.fills[name])
+        np.savez_compressed(file, origin=np.array(self.origin),
+                            shape=np.array(self.shape), **arrays)
+
+    @classmethod
+    def load(cls, data) -> 'Raster':
+        """Return the raster in data, a mapping of arrays as loaded from a
+        file saved by :py:meth:`save`."""
+        origin = tuple(int(n) for n in data['origin'])
+        shape = tuple(int(n) for n in data['shape'])
+        out = cls((origin[0], origin[1]), (shape[0], shape[1]))
+        for key in data:
+            if key.startswith('layer_'):
+                name = key[len('layer_'):]
+                out.layers[name] = data[key]
+                out.fills[name] = data['fill_' + name][()]
+        return out
+
+    def reduce_at(self, x: np.ndarray, y: np.ndarray, **updates) -> None:
+        """Reduce per-point values into the cells x, y of each point.
+
+        Each keyword argument is the name of a layer, and a pair of a
+        binary ufunc (eg ``np.add``, ``np.minimum``) and an array with a
+        value per point - or None to count points.  The points are grouped
+        by cell once, and each group is reduced with ``ufunc.reduceat``
+        then combined with the existing value of the cell.
+        """
+        if not np.size(x):
+            return
+        i, j = self.index(x, y)
+        flat = np.ravel_multi_index((i, j), self.shape)
+        order = np.argsort(flat, kind='stable')
+        flat = flat[order]
+        starts = np.flatnonzero(np.concatenate([[True], flat[1:] != flat[:-1]]))
+        cells = flat[starts]
+        for name, (ufunc, values) in updates.items():
+            layer = self.layers[name].reshape(-1)
+            if values is None:
+                reduced = np.diff(np.append(starts, flat.size))
+            else:
+                reduced = ufunc.reduceat(np.asarray(values)[order], starts)
+            layer[cells] = ufunc(layer[cells], reduced)
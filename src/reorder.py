@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Rewrite a point cloud in the order of a space-filling curve over its cells.
+
+Points from photogrammetry or LIDAR are stored in whatever order they were
+produced, so the points in any small area are scattered through the file.
+Sorting them along a Morton (Z-order) or Hilbert curve through the XY grid
+cells puts nearby points in nearby records, so that indexed reads (see
+:py:mod:`~src.tileindex`), tiles, and single trees each touch a few
+contiguous runs of the file.  Points in the same cell keep their order.
+
+Files larger than memory are sorted externally: sorted runs of points are
+spilled to temporary files, then merged.  Run as ``forestutils reorder``;
+see ``forestutils reorder --help`` for options.
+"""
+# pylint:disable=unsubscriptable-object,invalid-sequence-index
+
+import argparse
+import os
+from tempfile import TemporaryFile
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from . import pointcloudfile
+
+CURVES = ('hilbert', 'morton')
+
+
+def morton_keys(i: np.ndarray, j: np.ndarray, bits: int) -> np.ndarray:
+    """Return the position of each cell i, j along a Morton curve, by
+    interleaving the lowest bits of the (non-negative) coordinates."""
+    i, j = i.astype(np.uint64), j.astype(np.uint64)
+    key = np.zeros(i.shape, dtype=np.uint64)
+    for b in range(bits):
+        bit = np.uint64(b)
+        key |= ((i >> bit) & np.uint64(1)) << np.uint64(2 * b + 1)
+        key |= ((j >> bit) & np.uint64(1)) << np.uint64(2 * b)
+    return key
+
+
+def hilbert_keys(i: np.ndarray, j: np.ndarray, bits: int) -> np.ndarray:
+    """Return the position of each cell i, j along a Hilbert curve filling
+    a square of side ``2**bits``."""
+    x, y = i.astype(np.uint64), j.astype(np.uint64)
+    key = np.zeros(x.shape, dtype=np.uint64)
+    last = np.uint64(2**bits - 1)
+    for b in reversed(range(bits)):
+        s = np.uint64(1 << b)
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        key += s * s * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+        # Rotate the quadrant so the curve is continuous
+        flip = ~ry & rx
+        x = np.where(flip, last - x, x)
+        y = np.where(flip, last - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+    return key
+
+
+def _bounds(fname: str, cellsize: float):
+    """Return the minimum cell coordinates, and the bits needed for cells."""
+    lo, hi = np.full(2, np.inf), np.full(2, -np.inf)
+    for chunk in pointcloudfile.read_chunks(fname, 2**20):
+        if chunk.size:
+            lo = np.minimum(lo, [chunk['x'].min(), chunk['y'].min()])
+            hi = np.maximum(hi, [chunk['x'].max(), chunk['y'].max()])
+    if not np.isfinite(lo).all():
+        return np.zeros(2, np.int64), 1
+    lo, hi = np.floor(lo / cellsize), np.floor(hi / cellsize)
+    bits = int(hi.max() - lo.min() + 1).bit_length()
+    return lo.astype(np.int64), max(1, bits)
+
+
+def _sorted_runs(fname: str, dtype: np.dtype, cellsize: float, curve: str,
+                 memory: int) -> Iterator[np.ndarray]:
+    """Yield runs of records for the points in fname, each sorted by key
+    and using at most about half of memory."""
+    # pylint:disable=too-many-arguments,too-many-locals
+    origin, bits = _bounds(fname, cellsize)
+    keys = {'hilbert': hilbert_keys, 'morton': morton_keys}[curve]
+    run = []  # type: List[np.ndarray]
+    size = seq = 0
+    for chunk in pointcloudfile.read_chunks(fname):
+        records = np.empty(chunk.shape, dtype)
+        records['key'] = keys(
+            np.floor(chunk['x'] / cellsize).astype(np.int64) - origin[0],
+            np.floor(chunk['y'] / cellsize).astype(np.int64) - origin[1],
+            bits)
+        records['seq'] = np.arange(seq, seq + chunk.size)
+        seq += chunk.size
+        for name in chunk.dtype.names or ():
+            records['point'][name] = chunk[name]
+        run.append(records)
+        size += records.nbytes
+        if size > memory // 2:
+            yield _sort(run, dtype)
+            run, size = [], 0
+    if run:
+        yield _sort(run, dtype)
+
+
+def _sort(records: List[np.ndarray], dtype: np.dtype) -> np.ndarray:
+    """Return the concatenated records, sorted by key then sequence."""
+    # Numpy may concatenate to native byte order, so cast back
+    out = np.concatenate(records).astype(dtype)
+    return out[np.lexsort((out['seq'], out['key']))]
+
+
+def _merge(runs: list, dtype: np.dtype, memory: int) -> Iterator[np.ndarray]:
+    """Yield sorted chunks of the records in several sorted run files.
+
+    A block of each run is held in memory.  Records up to the smallest last
+    record of any block which is not the end of its run are certainly next
+    in order, so are merged and yielded, and emptied blocks are refilled.
+    """
+    size = max(1, memory // (2 * len(runs) * dtype.itemsize)) * dtype.itemsize
+    for f in runs:
+        f.seek(0)
+    blocks = [np.frombuffer(f.read(size), dtype) for f in runs]
+    done = [b.size * dtype.itemsize < size for b in blocks]
+    while any(b.size for b in blocks):
+        bound = min(((b['key'][-1], b['seq'][-1])
+                     for b, d in zip(blocks, done) if b.size and not d),
+                    default=None)
+        taken = []
+        for n, block in enumerate(blocks):
+            if bound is None:
+                take = np.ones(block.size, dtype=bool)
+            else:
+                take = ((block['key'] < bound[0]) | (
+                    (block['key'] == bound[0]) & (block['seq'] <= bound[1])))
+            taken.append(block[take])
+            blocks[n] = block[~take]
+            if not blocks[n].size and not done[n]:
+                blocks[n] = np.frombuffer(runs[n].read(size), dtype)
+                done[n] = blocks[n].size * dtype.itemsize < size
+        yield _sort(taken, dtype)
+
+
+def reorder(fname: str, out: str, cellsize: float=0.1,
+            curve: str='hilbert', memory: int=2**28,
+            utm: Optional[pointcloudfile.UTM_Coord]=None) -> None:
+    """Write the points in fname to out, sorted along a curve through the
+    XY cells of the given size, using about memory bytes.
+
+    Args:
+        fname: the input ``.ply`` file, or first part of a Pix4D cloud.
+        out: the file to write, which must not be the input.
+        curve: ``'hilbert'`` (better locality) or ``'morton'`` (Z-order).
+        utm: the location to save in the header of the output.
+    """
+    # pylint:disable=too-many-arguments
+    if curve not in CURVES:
+        raise ValueError('Unknown curve {}, expected one of {}'.format(
+            curve, CURVES))
+    if os.path.abspath(out) in (os.path.abspath(f) for f in
+                                pointcloudfile.pix4d_parts(fname)):
+        raise ValueError('Can not reorder a file in place')
+    header = pointcloudfile.read_header(fname)
+    dtype = np.dtype([
+        ('key', '<u8'), ('seq', '<u8'),
+        ('point', pointcloudfile.vertex_dtype(header).newbyteorder('>'))])
+    count = sum(p.stop for p in pointcloudfile.part_ranges(fname))
+    runs = []
+    last = np.empty(0, dtype)
+    with open(out, 'wb') as f:
+        f.write(pointcloudfile.ply_header_bytes(header, count, utm))
+        # Spill runs to disk only if there is more than one
+        for run in _sorted_runs(fname, dtype, cellsize, curve, memory):
+            if last.size:
+                runs.append(TemporaryFile())
+                runs[-1].write(last.tobytes())
+            last = run
+        if not runs:
+            f.write(last['point'].tobytes())
+        else:
+            runs.append(TemporaryFile())
+            runs[-1].write(last.tobytes())
+            del last
+            for chunk in _merge(runs, dtype, memory):
+                f.write(chunk['point'].tobytes())
+    for run_file in runs:
+        run_file.close()
+
+
+def get_args(argv=None):
+    """ Handle command-line arguments, including default values.
+    """
+    parser = argparse.ArgumentParser(
+        prog='forestutils reorder',
+        description=('Rewrites a .ply point cloud with points sorted along a '
+                     'space-filling curve through the grid cells.'))
+    parser.add_argument(
+        'file', help='name of the file to reorder', type=str)
+    parser.add_argument(
+        'out', default='', nargs='?', type=str,
+        help='file to write (default <name>_reordered.ply beside the input)')
+    parser.add_argument(
+        '--curve', default='hilbert', choices=CURVES,
+        help='space-filling curve to order cells by (default hilbert)')
+    parser.add_argument(
+        '--cellsize', default=0.1, type=float,
+        help='grid scale; points in the same cell keep their order')
+    parser.add_argument(
+        '--memory', default=256, type=int,
+        help='megabytes of points to sort in memory at once (default 256)')
+    parser.add_argument(
+        '--utmzone', default=55, type=int,
+        help='the UTM zone to record in the output (default 55)')
+    parser.add_argument(
+        '--north', action='store_true',
+        help='record that the site is in the northern hemisphere')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Reorder a point cloud, as for ``forestutils reorder``."""
+    args = get_args(argv)
+    out = args.out or (pointcloudfile.stem(args.file).replace('_part_1', '')
+                       + '_reordered.ply')
+    x, y, _ = pointcloudfile.offset_for(args.file)
+    print('Reordering "{}" to "{}" ...'.format(args.file, out))
+    reorder(args.file, out, args.cellsize, args.curve, args.memory * 2**20,
+            pointcloudfile.UTM_Coord(x, y, args.utmzone, args.north))
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
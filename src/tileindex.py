@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""A persistent spatial index of binary ``.ply`` files, for reading small
+areas of a large cloud without scanning all of it.
+
+The index divides the XY plane into square tiles, and records for each tile
+the number of points in it and the ranges of vertex records which contain
+those points.  It is saved beside the cloud as ``<name>.plyidx``, and
+rebuilt automatically if the size or modification time of the cloud
+changes.  :py:func:`read_bbox` uses the index to read only the records
+which may be in the requested area.
+
+Ranges are most compact when points are stored in spatial order, as after
+:py:mod:`~src.reorder`.  Otherwise, nearby runs of records in the same tile
+are joined if separated by at most ``gap`` records, trading a little extra
+reading for a smaller index.
+"""
+# pylint:disable=unsubscriptable-object,invalid-sequence-index
+
+import os
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from . import pointcloudfile
+
+VERSION = 1
+# Runs of records in a tile, while building an index
+RUN_DTYPE = np.dtype([('i', 'i8'), ('j', 'i8'), ('start', 'i8'),
+                      ('stop', 'i8'), ('count', 'i8')])
+
+
+class TileIndex:
+    """The tiles of a single ``.ply`` file, and the ranges of vertex records
+    for each tile.  Coordinates are as stored in the file, without any
+    Pix4D offsets.
+    """
+
+    def __init__(self, tile_size: float, stat: Tuple[int, int],
+                 tiles: np.ndarray, counts: np.ndarray, run_ptr: np.ndarray,
+                 runs: np.ndarray) -> None:
+        """
+        Args:
+            tile_size: the width of each square tile.
+            stat: the size and modification time in nanoseconds of the
+                indexed file, to detect changes.
+            tiles: an (n, 2) array of the integer coords of each tile.
+            counts: the number of points in each tile.
+            run_ptr: the runs for tile ``k`` are ``runs[run_ptr[k]:
+                run_ptr[k+1]]``.
+            runs: an (m, 2) array of the start and stop of each run of
+                vertex records.
+        """
+        # pylint:disable=too-many-arguments
+        self.tile_size = tile_size
+        self.stat = stat
+        self.tiles = tiles
+        self.counts = counts
+        self.run_ptr = run_ptr
+        self.runs = runs
+
+    def ranges(self, xmin: float, ymin: float, xmax: float,
+               ymax: float) -> List[Tuple[int, int]]:
+        """Return sorted, disjoint (start, stop) ranges of vertex records
+        which include every point in the given box."""
+        # Allow for rounding when points are offset to real coordinates
+        pad = 1e-6 * self.tile_size
+        lo = np.floor((np.array([xmin, ymin]) - pad) / self.tile_size)
+        hi = np.floor((np.array([xmax, ymax]) + pad) / self.tile_size)
+        selected = np.flatnonzero(
+            ((self.tiles >= lo) & (self.tiles <= hi)).all(axis=1))
+        if not selected.size:
+            return []
+        runs = np.concatenate([self.runs[self.run_ptr[k]:self.run_ptr[k + 1]]
+                               for k in selected.tolist()])
+        runs = runs[np.argsort(runs[:, 0], kind='stable')]
+        # Join overlapping or adjacent runs from different tiles
+        stops = np.maximum.accumulate(runs[:, 1])
+        new = np.concatenate([[True], runs[1:, 0] > stops[:-1]])
+        starts = np.flatnonzero(new)
+        ends = np.append(starts[1:], runs.shape[0]) - 1
+        return list(zip(runs[starts, 0].tolist(), stops[ends].tolist()))
+
+    def save(self, fname: str) -> None:
+        """Save the index to fname."""
+        with open(fname, 'wb') as f:
+            np.savez(f, version=VERSION, tile_size=self.tile_size,
+                     stat=np.array(self.stat, dtype=np.int64),
+                     tiles=self.tiles, counts=self.counts,
+                     run_ptr=self.run_ptr, runs=self.runs)
+
+    @classmethod
+    def load(cls, fname: str) -> 'TileIndex':
+        """Load an index saved by :py:meth:`save`."""
+        with np.load(fname) as data:
+            if int(data['version']) != VERSION:
+                raise ValueError('Unknown version of index file ' + fname)
+            size, mtime = np.asarray(data['stat'], dtype=np.int64)
+            return cls(float(data['tile_size']), (int(size), int(mtime)),
+                       data['tiles'], data['counts'], data['run_ptr'],
+                       data['runs'])
+
+
+def index_fname(fname: str) -> str:
+    """Return the name of the sidecar index for a .ply file."""
+    return pointcloudfile.stem(fname) + '.plyidx'
+
+
+def _stat(fname: str) -> Tuple[int, int]:
+    """Return the size and modification time of the file, for staleness."""
+    info = os.stat(fname)
+    return info.st_size, info.st_mtime_ns
+
+
+def _merge_runs(runs: np.ndarray, gap: int) -> np.ndarray:
+    """Join runs of the same tile which are at most gap records apart.
+
+    runs is a structured array with fields i, j (the tile), start, stop,
+    and count; the result is sorted by tile and start.
+    """
+    if not runs.size:
+        return runs
+    runs = runs[np.lexsort((runs['start'], runs['j'], runs['i']))]
+    new = np.concatenate([[True], (
+        (runs['i'][1:] != runs['i'][:-1]) | (runs['j'][1:] != runs['j'][:-1])
+        | (runs['start'][1:] - runs['stop'][:-1] > gap))])
+    starts = np.flatnonzero(new)
+    out = runs[starts]
+    out['stop'] = np.maximum.reduceat(runs['stop'], starts)
+    out['count'] = np.add.reduceat(runs['count'], starts)
+    return out
+
+
+def build_index(fname: str, tile_size: float=10.0, gap: int=256,
+                chunk_size: int=2**20) -> TileIndex:
+    """Index the points in a single .ply file, and save the index beside it.
+
+    Reads the file once, in chunks, holding only the runs of records found
+    so far in memory.
+    """
+    stat = _stat(fname)
+    count = pointcloudfile.read_header(fname).vertex_count
+    found = []  # type: List[np.ndarray]
+    chunks = pointcloudfile.read_range(
+        pointcloudfile.VertexRange(fname, 0, count, (0, 0, 0)), chunk_size)
+    for start, chunk in zip(range(0, count, chunk_size), chunks):
+        i = np.floor(chunk['x'] / tile_size).astype(np.int64)
+        j = np.floor(chunk['y'] / tile_size).astype(np.int64)
+        # Each run is a sequence of consecutive records in the same tile
+        first = np.flatnonzero(np.concatenate(
+            [[True], (i[1:] != i[:-1]) | (j[1:] != j[:-1])]))
+        runs = np.empty(first.size, dtype=RUN_DTYPE)
+        runs['i'], runs['j'] = i[first], j[first]
+        runs['start'] = start + first
+        runs['stop'] = start + np.append(first[1:], i.size)
+        runs['count'] = np.diff(np.append(first, i.size))
+        found.append(_merge_runs(runs, gap))
+        if len(found) > 16:
+            found = [_merge_runs(np.concatenate(found), gap)]
+    runs = _merge_runs(np.concatenate(found + [np.empty(0, RUN_DTYPE)]), gap)
+    index = _group_runs(runs, tile_size, stat)
+    index.save(index_fname(fname))
+    return index
+
+
+def _group_runs(runs: np.ndarray, tile_size: float,
+                stat: Tuple[int, int]) -> TileIndex:
+    """Return an index of the runs, which are sorted by tile."""
+    first = np.flatnonzero(np.concatenate([[True], (
+        (runs['i'][1:] != runs['i'][:-1]) |
+        (runs['j'][1:] != runs['j'][:-1]))]))[:runs.size]
+    counts = np.zeros(first.size, np.int64)
+    if runs.size:
+        counts = np.add.reduceat(runs['count'], first)
+    return TileIndex(
+        tile_size, stat,
+        tiles=np.stack([runs['i'][first], runs['j'][first]], axis=1),
+        counts=counts, run_ptr=np.append(first, runs.size).astype(np.int64),
+        runs=np.stack([runs['start'], runs['stop']], axis=1))
+
+
+def load_index(fname: str, tile_size: float=10.0,
+               gap: int=256) -> TileIndex:
+    """Return the index for a single .ply file, building and saving it if
+    the sidecar is missing, out of date, or for another tile size."""
+    idx = index_fname(fname)
+    if os.path.isfile(idx):
+        try:
+            index = TileIndex.load(idx)
+            if index.stat == _stat(fname) and index.tile_size == tile_size:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    return build_index(fname, tile_size, gap)
+
+
+def read_bbox(fname: str, xmin: float, ymin: float, xmax: float,
+              ymax: float, chunk_size: int=2**18,
+              tile_size: float=10.0) -> Iterator[np.ndarray]:
+    """Yield chunks of the points with ``xmin <= x <= xmax`` and
+    ``ymin <= y <= ymax``, as for :py:func:`~src.pointcloudfile.read_chunks`.
+
+    Only the ranges of records listed in the index of each tile touching the
+    box are read, so cost depends on the size of the box rather than the
+    cloud.  Each part of a Pix4D multi-part cloud has its own index.
+    """
+    # pylint:disable=too-many-arguments
+    for part in pointcloudfile.part_ranges(fname):
+        dx, dy, _ = part.offset
+        index = load_index(part.fname, tile_size)
+        for start, stop in index.ranges(xmin - dx, ymin - dy,
+                                        xmax - dx, ymax - dy):
+            for chunk in pointcloudfile.read_range(
+                    part._replace(start=start, stop=stop), chunk_size):
+                chunk = chunk[(chunk['x'] >= xmin) & (chunk['x'] <= xmax) &
+                              (chunk['y'] >= ymin) & (chunk['y'] <= ymax)]
+                if chunk.size:
+                    yield chunk